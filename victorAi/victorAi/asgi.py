@@ -1,4 +1,5 @@
 import os
+import sys
 from django.core.asgi import get_asgi_application
 
 # Set the settings module
@@ -9,12 +10,25 @@ django_asgi_app = get_asgi_application()
 
 # Now import channels components
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
+from victorAiApp.middleware import JWTAuthMiddlewareStack
 from victorAiApp.routing import websocket_urlpatterns
+from victorAiApp.metrics import registry
+from victorAiApp.services import turns
 
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
-    "websocket": AuthMiddlewareStack(
+    "websocket": JWTAuthMiddlewareStack(
         URLRouter(websocket_urlpatterns)
     ),
-})
\ No newline at end of file
+})
+
+# Share metrics with the generation workers, then launch them now rather
+# than on the first message
+registry.start(private=True)
+turns.pool.start()
+
+# Daphne runs on Twisted, whose reactor waits for this before it shuts down
+if "twisted.internet.reactor" in sys.modules:
+    from twisted.internet import reactor
+
+    turns.drain_before_shutdown(reactor)
@@ -34,7 +34,7 @@ ALLOWED_HOSTS = ['localhost', 'ai-chatbot-backend-1-2zoe.onrender.com', '127.0.0
 CORS_ALLOWED_ORIGINS = [
     "http://127.0.0.1:3000",
     "http://localhost:3000",
-    "ai-chatbot-backend-1-2zoe.onrender.com"
+    "https://ai-chatbot-backend-1-2zoe.onrender.com"
 ]
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOW_ALL_ORIGINS = True
@@ -71,10 +71,114 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer'
+# CHANNEL_LAYER selects the backend. "memory" only works within one process;
+# "redis" and "redis-pubsub" use channels_redis at REDIS_URL so groups span
+# every Daphne worker. For local multi-process runs without Redis, start
+# `python manage.py runbroker` and use "redis-pubsub".
+CHANNEL_LAYER = os.getenv('CHANNEL_LAYER', 'memory')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379')
+
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+                'capacity': int(os.getenv('CHANNEL_LAYER_CAPACITY', '1000')),
+                'expiry': 10,
+            },
+        }
     }
+elif CHANNEL_LAYER == 'redis-pubsub':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.pubsub.RedisPubSubChannelLayer',
+            'CONFIG': {
+                'hosts': [REDIS_URL],
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer'
+        }
+    }
+
+# Response generation runs off the event loop. EXECUTOR is "thread",
+# "process" (a hung generation can be killed, at about 1 ms a call for the
+# round trip; worth it for backends without their own bounds) or "inline".
+# Past MAX_PENDING running or queued generations new messages are refused with
+# a "busy" error.
+CHAT_GENERATION = {
+    'EXECUTOR': os.getenv('CHAT_GENERATION_EXECUTOR', 'thread'),
+    'WORKERS': int(os.getenv('CHAT_GENERATION_WORKERS', '2')),
+    'TIMEOUT': float(os.getenv('CHAT_GENERATION_TIMEOUT', '2')),
+    'MAX_PENDING': int(os.getenv('CHAT_GENERATION_MAX_PENDING', '64')),
+}
+
+# Which backend writes the replies: "rules" (intent tables and calculator),
+# "ngram" (a local bigram model stand-in) or "http" (a model server at URL).
+# Other backends fall back to the rules when MAX_CONCURRENCY calls are already
+# running or a reply misses LATENCY_BUDGET seconds. With BATCH_WINDOW above 0,
+# messages arriving within that many seconds of each other (up to MAX_BATCH)
+# are generated as one batch.
+CHAT_GENERATOR = {
+    'BACKEND': os.getenv('CHAT_GENERATOR_BACKEND', 'rules'),
+    'URL': os.getenv('CHAT_GENERATOR_URL', 'http://127.0.0.1:8081/generate'),
+    'MAX_CONCURRENCY': int(os.getenv('CHAT_GENERATOR_MAX_CONCURRENCY', '8')),
+    'LATENCY_BUDGET': float(os.getenv('CHAT_GENERATOR_LATENCY_BUDGET', '1.5')),
+    'TOKEN_DELAY': float(os.getenv('CHAT_GENERATOR_TOKEN_DELAY', '0')),
+    'BATCH_WINDOW': float(os.getenv('CHAT_GENERATOR_BATCH_WINDOW', '0')),
+    'MAX_BATCH': int(os.getenv('CHAT_GENERATOR_MAX_BATCH', '16')),
+}
+
+# What a context-aware generator sees of a conversation: recent turns and a
+# summary of older ones, within MAX_TOKENS of which SUMMARY_TOKENS go to the
+# summary. A conversation rolls over to a new one after MAX_MESSAGES, 0 never.
+# Clients are sent the last HISTORY_MESSAGES of a conversation in snapshots
+# and chat replies, older ones are paged in through the messages API.
+CHAT_CONTEXT = {
+    'MAX_TOKENS': int(os.getenv('CHAT_CONTEXT_MAX_TOKENS', '1024')),
+    'SUMMARY_TOKENS': int(os.getenv('CHAT_CONTEXT_SUMMARY_TOKENS', '256')),
+    'MAX_MESSAGES': int(os.getenv('CHAT_CONVERSATION_MAX_MESSAGES', '20')),
+    'HISTORY_MESSAGES': int(os.getenv('CHAT_HISTORY_MESSAGES', '50')),
+}
+
+# WebSocket flow control. Each socket may send CONNECTION_RATE messages per
+# second (bursts of CONNECTION_BURST) and all sockets of one user, or of one
+# address when anonymous, USER_RATE (bursts of USER_BURST) per worker process.
+# The address is the client's as forwarded by the proxy, see --proxy-headers
+# in the Procfile. Up to INBOUND_QUEUE accepted messages wait while one is
+# being answered; past either limit messages are dropped with an error frame.
+CHAT_LIMITS = {
+    'CONNECTION_RATE': float(os.getenv('CHAT_LIMIT_CONNECTION_RATE', '1')),
+    'CONNECTION_BURST': int(os.getenv('CHAT_LIMIT_CONNECTION_BURST', '5')),
+    'USER_RATE': float(os.getenv('CHAT_LIMIT_USER_RATE', '2')),
+    'USER_BURST': int(os.getenv('CHAT_LIMIT_USER_BURST', '10')),
+    'INBOUND_QUEUE': int(os.getenv('CHAT_LIMIT_INBOUND_QUEUE', '8')),
+}
+
+# Dead peers are found by Daphne's protocol-level pings (--ping-interval and
+# --ping-timeout in the Procfile). On top of that a socket that neither sends
+# a message, pings included, nor is sent a conversation update for
+# IDLE_TIMEOUT seconds is closed (code 4011), 0 keeps idle sockets open.
+# Clients may send {"type": "ping"} and get a "pong" back.
+CHAT_IDLE_TIMEOUT = float(os.getenv('CHAT_IDLE_TIMEOUT', '900'))
+
+# /metrics/ is served to requests with "Authorization: Bearer <METRICS_TOKEN>",
+# for Prometheus, and to logged in staff. Unset, only staff can read it.
+CHAT_METRICS_TOKEN = os.getenv('CHAT_METRICS_TOKEN', '')
+
+# Write-behind chat persistence: replies are sent before the turn is stored and
+# a background flusher saves turns in batches of MAX_BATCH or every FLUSH_INTERVAL
+# seconds. DURABILITY "reply_first" may lose the last window of turns on a crash,
+# "persist_first" waits for the batch to commit before replying.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'False').lower() == 'true',
+    'MAX_BATCH': int(os.getenv('CHAT_WRITE_BEHIND_MAX_BATCH', '50')),
+    'FLUSH_INTERVAL': float(os.getenv('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', '0.05')),
+    'DURABILITY': os.getenv('CHAT_WRITE_BEHIND_DURABILITY', 'reply_first'),
 }
 
 ROOT_URLCONF = 'victorAi.urls'
@@ -109,12 +213,58 @@ ASGI_APPLICATION = 'victorAi.asgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_ENGINE selects the profile: "sqlite" (default) or "postgresql".
+# Connections are kept open for DB_CONN_MAX_AGE seconds so each
+# database_sync_to_async call does not reconnect.
+DATABASE_ENGINE = os.getenv('DATABASE_ENGINE', 'sqlite')
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', '60'))
+
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'victorai'),
+            'USER': os.getenv('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
     }
-}
+    # psycopg 3 connection pool, replaces persistent connections when enabled
+    if os.getenv('DB_POOL', 'False').lower() == 'true':
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            'max_size': int(os.getenv('DB_POOL_MAX_SIZE', '20')),
+            'timeout': float(os.getenv('DB_POOL_TIMEOUT', '10')),
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before "database is locked"
+                'timeout': float(os.getenv('SQLITE_BUSY_TIMEOUT', '20')),
+            },
+        }
+    }
+    # WAL lets readers run alongside the writer and NORMAL syncs once per
+    # checkpoint instead of every commit; IMMEDIATE takes the write lock at BEGIN.
+    if os.getenv('SQLITE_TUNED', 'True').lower() == 'true':
+        DATABASES['default']['OPTIONS'].update({
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                f"PRAGMA mmap_size={int(os.getenv('SQLITE_MMAP_SIZE', str(128 * 1024 * 1024)))};"
+                'PRAGMA cache_size=-20000;'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+        })
 # SECRET_KEY = os.getenv("SECRET_KEY")
 # print("SECRET_KEY:", SECRET_KEY, type(SECRET_KEY))
 
@@ -168,7 +318,7 @@ SIMPLE_JWT = {
     # "UPDATE_LAST_LOGIN": False,
 
     "ALGORITHM": "HS256",
-    "SIGNING_KEY": os.getenv('SECRET_KEY'),
+    "SIGNING_KEY": SECRET_KEY,
 
     "AUTH_HEADER_TYPES": ("Bearer",),
     "AUTH_HEADER_NAME": "HTTP_AUTHORIZATION",
@@ -5,3 +5,4 @@ from .models import *
 admin.site.register(UserChat)
 admin.site.register(VictorAi)
 admin.site.register(AiMemory)
+admin.site.register(MemoryMessage)
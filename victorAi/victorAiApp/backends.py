@@ -0,0 +1,268 @@
+# backends.py
+import asyncio
+import json
+import random
+import re
+import urllib.request
+from django.conf import settings
+from .generation import GenerationPool, PoolSaturated
+from .handlers import ResponseHandler, intents
+
+# A word with the whitespace after it, so the chunks join back to the reply
+_CHUNK_RE = re.compile(r"\S+\s*|\s+")
+_WORD_RE = re.compile(r"\S+")
+
+
+class GeneratorBackend:
+    """
+    Something that writes replies to chat messages.
+
+    Backends implement generate(); generate_batch() and stream() fall back
+    to it, so a backend only overrides them when it can do better, e.g. a
+    model server that takes several prompts per request.
+    """
+    name = "base"
+    # Whether replies depend on the conversation, see context.ContextBuilder.
+    # Building the context costs a database read per turn.
+    uses_context = False
+
+    async def generate(self, message: str, context: dict | None = None) -> str:
+        raise NotImplementedError
+
+    async def generate_batch(self, messages: list[str], contexts: list | None = None) -> list[str]:
+        contexts = contexts or [None] * len(messages)
+        return list(await asyncio.gather(*(
+            self.generate(message, context) for message, context in zip(messages, contexts)
+        )))
+
+    async def stream(self, message: str, context: dict | None = None):
+        for chunk in _CHUNK_RE.findall(await self.generate(message, context)):
+            yield chunk
+
+
+class RuleBackend(GeneratorBackend):
+    """The intent tables and calculator, run in the generation pool."""
+    name = "rules"
+
+    def __init__(self, pool: GenerationPool):
+        self.pool = pool
+
+    async def generate(self, message, context=None):
+        return await self.pool.run(ResponseHandler.process, message)
+
+    async def generate_batch(self, messages, contexts=None):
+        # One trip to the pool for the whole batch
+        return await self.pool.run(ResponseHandler.process_batch, messages)
+
+
+class NgramModel:
+    """A word bigram model trained on the intent replies."""
+
+    def __init__(self, texts):
+        self.starts = []
+        self.following = {}
+        for text in texts:
+            words = _WORD_RE.findall(text)
+            if not words:
+                continue
+            self.starts.append(words[0])
+            for word, after in zip(words, words[1:] + [None]):
+                self.following.setdefault(word.lower(), []).append(after)
+
+    def generate(self, prompt, max_words=30):
+        # Start from a word of the prompt the model knows, if there is one
+        known = [word for word in _WORD_RE.findall(prompt) if word.lower() in self.following]
+        word = random.choice(known) if known else random.choice(self.starts or [""])
+        words = [word]
+        while word and len(words) < max_words:
+            word = random.choice(self.following.get(word.lower(), [None]))
+            if word:
+                words.append(word)
+        return " ".join(words)
+
+
+_ngram_model = (None, None)
+
+
+def ngram_reply(message):
+    """Generate with the n-gram model of this process, retrained when the intents change."""
+    global _ngram_model
+    table = intents.current()
+    if _ngram_model[0] is not table:
+        texts = []
+        for _, reply in table.intents:
+            texts += reply if isinstance(reply, list) else [reply]
+        _ngram_model = (table, NgramModel(texts))
+    return _ngram_model[1].generate(message)
+
+
+class NgramBackend(GeneratorBackend):
+    """
+    A small local model stand-in. Replies are sampled from a bigram model in
+    the generation pool, then streamed a word at a time every `token_delay`
+    seconds to behave like a model decoding tokens.
+    """
+    name = "ngram"
+
+    def __init__(self, pool: GenerationPool, token_delay=0.0):
+        self.pool = pool
+        self.token_delay = token_delay
+
+    async def generate(self, message, context=None):
+        return "".join([chunk async for chunk in self.stream(message)])
+
+    async def stream(self, message, context=None):
+        reply = await self.pool.run(ngram_reply, message)
+        for chunk in _CHUNK_RE.findall(reply):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield chunk
+
+
+class HTTPBackend(GeneratorBackend):
+    """
+    A model server taking {"messages": [...], "contexts": [...]} and answering
+    {"replies": [...]} as JSON, one batch per request. Each context holds the
+    conversation summary and recent messages. The runmodelserver command
+    serves a fake one for local testing.
+    """
+    name = "http"
+    uses_context = True
+
+    def __init__(self, url, timeout=5.0):
+        self.url = url
+        self.timeout = timeout
+
+    async def generate(self, message, context=None):
+        return (await self.generate_batch([message], [context]))[0]
+
+    async def generate_batch(self, messages, contexts=None):
+        return await asyncio.to_thread(self.post, messages, contexts or [None] * len(messages))
+
+    def post(self, messages, contexts):
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps({"messages": messages, "contexts": contexts}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            replies = json.load(response)["replies"]
+        if len(replies) != len(messages):
+            raise ValueError(f"Expected {len(messages)} replies, got {len(replies)}")
+        return replies
+
+
+class FallbackBackend(GeneratorBackend):
+    """
+    Guards a backend with a concurrency limit and a latency budget, answering
+    with `fallback` (the rule engine) when either is exceeded or the backend
+    fails.
+
+    Past `max_concurrency` running calls new messages go straight to the
+    fallback instead of queueing. A streamed reply falls back only if its
+    first chunk misses the budget; once chunks are out it runs to the end.
+    """
+
+    def __init__(self, backend, fallback, max_concurrency=8, latency_budget=1.5):
+        self.backend = backend
+        self.fallback = fallback
+        self.name = backend.name
+        self.max_concurrency = max_concurrency
+        self.latency_budget = latency_budget
+        self.uses_context = backend.uses_context
+        self.active = 0
+        self.fallbacks = 0
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "fallbacks": self.fallbacks,
+        }
+
+    async def generate(self, message, context=None):
+        return await self.guarded(
+            self.backend.generate(message, context), lambda: self.fallback.generate(message, context)
+        )
+
+    async def generate_batch(self, messages, contexts=None):
+        return await self.guarded(
+            self.backend.generate_batch(messages, contexts), lambda: self.fallback.generate_batch(messages, contexts)
+        )
+
+    async def guarded(self, call, fallback):
+        if self.active >= self.max_concurrency:
+            call.close()
+            self.fallbacks += 1
+            return await fallback()
+        self.active += 1
+        try:
+            return await asyncio.wait_for(call, self.latency_budget)
+        except PoolSaturated:
+            raise
+        except Exception as e:
+            print(f"{self.name} backend failed, using the rule engine: {e!r}")
+            self.fallbacks += 1
+        finally:
+            self.active -= 1
+        return await fallback()
+
+    async def stream(self, message, context=None):
+        if self.active >= self.max_concurrency:
+            self.fallbacks += 1
+            async for chunk in self.fallback.stream(message, context):
+                yield chunk
+            return
+
+        self.active += 1
+        chunks = self.backend.stream(message, context)
+        try:
+            try:
+                first = await asyncio.wait_for(anext(chunks), self.latency_budget)
+            except StopAsyncIteration:
+                return
+            except PoolSaturated:
+                raise
+            except Exception as e:
+                print(f"{self.name} backend failed, using the rule engine: {e!r}")
+                self.fallbacks += 1
+                first = None
+
+            if first is None:
+                async for chunk in self.fallback.stream(message, context):
+                    yield chunk
+                return
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.active -= 1
+            await chunks.aclose()
+
+
+def backend_from_settings(pool: GenerationPool) -> GeneratorBackend:
+    from .batching import BatchScheduler
+
+    config = getattr(settings, "CHAT_GENERATOR", {})
+    rules = RuleBackend(pool)
+    name = config.get("BACKEND", "rules")
+    if name == "rules":
+        backend = rules
+    elif name == "ngram":
+        backend = NgramBackend(pool, token_delay=config.get("TOKEN_DELAY", 0.0))
+    elif name == "http":
+        backend = HTTPBackend(config["URL"], timeout=config.get("LATENCY_BUDGET", 1.5))
+    else:
+        raise ValueError(f"Unknown CHAT_GENERATOR backend {name!r}")
+
+    if config.get("BATCH_WINDOW"):
+        backend = BatchScheduler(backend, window=config["BATCH_WINDOW"], max_batch=config.get("MAX_BATCH", 16))
+    if name == "rules":
+        return backend
+    return FallbackBackend(
+        backend,
+        rules,
+        max_concurrency=config.get("MAX_CONCURRENCY", 8),
+        latency_budget=config.get("LATENCY_BUDGET", 1.5),
+    )
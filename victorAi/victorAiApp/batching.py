@@ -0,0 +1,100 @@
+# batching.py
+import asyncio
+from .backends import GeneratorBackend
+
+
+class BatchScheduler(GeneratorBackend):
+    """
+    Collects messages arriving from different sockets at about the same time
+    and hands them to the backend as one generate_batch() call.
+
+    A batch closes `window` seconds after its first message arrived or once
+    it holds `max_batch` messages, so batching adds at most `window` to any
+    reply. Batches run concurrently; the next one starts collecting while the
+    previous is still being generated. Each caller gets its own reply; if the
+    batch fails, its messages are generated one by one so each caller gets
+    its own reply or exception.
+    """
+
+    def __init__(self, backend, window=0.005, max_batch=16):
+        self.backend = backend
+        self.name = backend.name
+        self.uses_context = backend.uses_context
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = None
+        self.collector = None
+        self.running = set()
+        self.batches = 0
+        self.messages = 0
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "batches": self.batches,
+            "messages": self.messages,
+            "average_batch": self.messages / self.batches if self.batches else 0,
+        }
+
+    async def generate(self, message, context=None):
+        loop = asyncio.get_running_loop()
+        if self.collector is None or self.collector.done() or self.collector.get_loop() is not loop:
+            self.queue = asyncio.Queue()
+            self.collector = loop.create_task(self.collect())
+        future = loop.create_future()
+        self.queue.put_nowait((message, context, future))
+        return await future
+
+    async def generate_batch(self, messages, contexts=None):
+        return await self.backend.generate_batch(messages, contexts)
+
+    async def stream(self, message, context=None):
+        if type(self.backend).stream is GeneratorBackend.stream:
+            # The backend can't stream, so batch it and cut up its reply
+            async for chunk in super().stream(message, context):
+                yield chunk
+        else:
+            async for chunk in self.backend.stream(message, context):
+                yield chunk
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            task = loop.create_task(self.run(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def run(self, batch):
+        self.batches += 1
+        self.messages += len(batch)
+        try:
+            replies = await self.backend.generate_batch(
+                [message for message, _, _ in batch], [context for _, context, _ in batch]
+            )
+        except Exception as e:
+            if len(batch) == 1:
+                replies = [e]
+            else:
+                # One bad message, e.g. one that times out, shouldn't fail the
+                # others, so run them one by one and let each fail on its own
+                replies = await asyncio.gather(
+                    *(self.backend.generate(message, context) for message, context, _ in batch),
+                    return_exceptions=True,
+                )
+        for (_, _, future), reply in zip(batch, replies):
+            if future.done():
+                continue
+            if isinstance(reply, Exception):
+                future.set_exception(reply)
+            else:
+                future.set_result(reply)
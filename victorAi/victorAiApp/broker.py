@@ -0,0 +1,132 @@
+# broker.py
+import asyncio
+
+
+class PubSubBroker:
+    """
+    A local stand-in for Redis, for running several worker processes on one
+    machine without a Redis server.
+
+    It speaks just enough of the Redis protocol (RESP2 and RESP3) for
+    channels_redis' RedisPubSubChannelLayer: HELLO, SUBSCRIBE, UNSUBSCRIBE,
+    PUBLISH and PING.
+    Messages live only in memory and are dropped when nobody is subscribed,
+    so use a real Redis in production.
+    """
+
+    def __init__(self):
+        self.subscribers = {}
+
+    async def start(self, host="127.0.0.1", port=6379):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def handle(self, reader, writer):
+        subscribed = set()
+        protocol = 2
+        try:
+            while True:
+                command = await self.read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper() if command else b""
+
+                if name == b"PUBLISH" and len(command) == 3:
+                    channel, data = command[1], command[2]
+                    receivers = self.subscribers.get(channel, {})
+                    frames = {}
+                    for receiver, receiver_protocol in receivers.items():
+                        if receiver_protocol not in frames:
+                            frames[receiver_protocol] = self.encode([b"message", channel, data], push=receiver_protocol == 3)
+                        receiver.write(frames[receiver_protocol])
+                    writer.write(b":%d\r\n" % len(receivers))
+                elif name == b"SUBSCRIBE":
+                    for channel in command[1:]:
+                        self.subscribers.setdefault(channel, {})[writer] = protocol
+                        subscribed.add(channel)
+                        writer.write(self.encode([b"subscribe", channel, len(subscribed)], push=protocol == 3))
+                elif name == b"UNSUBSCRIBE":
+                    for channel in command[1:] or list(subscribed) or [None]:
+                        if channel is not None:
+                            self.unsubscribe(writer, channel)
+                            subscribed.discard(channel)
+                        writer.write(self.encode([b"unsubscribe", channel, len(subscribed)], push=protocol == 3))
+                elif name == b"HELLO":
+                    if len(command) > 1 and command[1] in (b"2", b"3"):
+                        protocol = int(command[1])
+                    writer.write(self.encode_map({
+                        b"server": b"redis", b"version": b"7.0.0", b"proto": protocol,
+                        b"id": id(writer), b"mode": b"standalone", b"role": b"master", b"modules": [],
+                    }, protocol))
+                elif name == b"PING":
+                    message = command[1] if len(command) > 1 else b""
+                    if subscribed and protocol == 2:
+                        writer.write(self.encode([b"pong", message]))
+                    else:
+                        writer.write(self.encode(message) if message else b"+PONG\r\n")
+                elif name == b"QUIT":
+                    writer.write(b"+OK\r\n")
+                    break
+                elif name in (b"CLIENT", b"SELECT"):
+                    writer.write(b"+OK\r\n")
+                else:
+                    writer.write(b"-ERR unknown command '%s'\r\n" % name)
+                await writer.drain()
+        except ValueError:
+            # Malformed length or type: the stream can't be resynced, so give up on it
+            writer.write(b"-ERR protocol error\r\n")
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Client went away or the broker is shutting down
+            pass
+        finally:
+            for channel in subscribed:
+                self.unsubscribe(writer, channel)
+            writer.close()
+
+    def unsubscribe(self, writer, channel):
+        receivers = self.subscribers.get(channel)
+        if receivers is not None:
+            receivers.pop(writer, None)
+            if not receivers:
+                del self.subscribers[channel]
+
+    @staticmethod
+    async def read_command(reader):
+        """
+        Read one command as a list of bytes, or None once the client is gone.
+        Raises ValueError on a malformed length or argument type.
+        """
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # Inline command, e.g. typed into telnet
+            return line.split()
+        arguments = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            if not header:
+                raise asyncio.IncompleteReadError(b"", None)
+            if not header.startswith(b"$"):
+                raise ValueError(f"expected a bulk string, got {header[:1]!r}")
+            size = int(header[1:])
+            if size < 0:
+                raise ValueError(f"invalid bulk length {size}")
+            arguments.append((await reader.readexactly(size + 2))[:-2])
+        return arguments
+
+    @classmethod
+    def encode(cls, value, push=False):
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return (b">" if push else b"*") + b"%d\r\n" % len(value) + b"".join(cls.encode(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    @classmethod
+    def encode_map(cls, value, protocol):
+        pairs = b"".join(cls.encode(key) + cls.encode(item) for key, item in value.items())
+        if protocol == 3:
+            return b"%%%d\r\n" % len(value) + pairs
+        return b"*%d\r\n" % (2 * len(value)) + pairs
@@ -0,0 +1,63 @@
+# connections.py
+import asyncio
+from django.conf import settings
+from .metrics import registry
+
+IDLE_TIMEOUT = getattr(settings, "CHAT_IDLE_TIMEOUT", 900)
+
+
+class ConnectionTasks:
+    """
+    The background tasks of one WebSocket connection. Every task is started
+    through start() and cancelled by close(), so nothing outlives the socket.
+
+    The class attributes are process-wide gauges: `connections` holding tasks
+    and `live` tasks across all of them. During connection churn `live`
+    should stay a small multiple of `connections`.
+    """
+    connections = 0
+    live = 0
+
+    def __init__(self):
+        self.tasks = set()
+        self.closed = False
+        ConnectionTasks.connections += 1
+
+    def start(self, coro):
+        if self.closed:
+            coro.close()
+            return None
+        task = asyncio.ensure_future(coro)
+        self.tasks.add(task)
+        ConnectionTasks.live += 1
+        task.add_done_callback(self.finished)
+        return task
+
+    def finished(self, task):
+        self.tasks.discard(task)
+        ConnectionTasks.live -= 1
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Connection task failed: {task.exception()!r}")
+
+    async def close(self):
+        """Cancel every task and wait until they are gone."""
+        if self.closed:
+            return
+        self.closed = True
+        ConnectionTasks.connections -= 1
+        current = asyncio.current_task()
+        tasks = [task for task in self.tasks if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+registry.gauge("chat_open_sockets", "Open WebSocket connections", lambda: ConnectionTasks.connections)
+registry.gauge("chat_connection_tasks", "Background tasks of open connections", lambda: ConnectionTasks.live)
+
+
+def stats():
+    return {
+        "connections": ConnectionTasks.connections,
+        "tasks": ConnectionTasks.live,
+    }
@@ -4,45 +4,188 @@ import asyncio
 import hashlib
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
-from .models import UserChat, VictorAi, AiMemory
-from .handlers import ResponseHandler
+from django.db.models import Prefetch
+from .connections import IDLE_TIMEOUT, ConnectionTasks
+from .limits import LIMITS, connection_bucket, user_buckets
+from .metrics import update_serialize_seconds
+from .models import AiMemory, MemoryMessage
+from .services import HISTORY_MESSAGES, conversations_group, turns
+
+
+# Conversations in a snapshot, most recently updated first
+SNAPSHOT_CONVERSATIONS = 5
+
+
+def entry_title(title, messages):
+    if messages:
+        first_message = messages[0]
+        return title or first_message.get('user', '')[:50] + "..." if first_message.get('user') else "New Conversation"
+    return title or "Empty Conversation"
+
+
+def recent_entries():
+    """Prefetches the last HISTORY_MESSAGES messages of each conversation, newest first"""
+    return Prefetch(
+        "entries", queryset=MemoryMessage.objects.order_by("-sequence")[:HISTORY_MESSAGES], to_attr="recent"
+    )
+
+
+def conversation_entry(memory):
+    """
+    Serialize an AiMemory row as a full conversation_update entry: its last
+    HISTORY_MESSAGES messages, the first of them at sequence `offset`.
+    """
+    recent = getattr(memory, "recent", None)
+    if recent is None:
+        recent = list(memory.entries.filter(sequence__gte=memory.message_count - HISTORY_MESSAGES))
+    else:
+        recent = recent[::-1]
+    messages = [entry.content for entry in recent]
+    return {
+        "id": str(memory.id),
+        "title": entry_title(memory.title, messages),
+        "revision": memory.revision,
+        "offset": recent[0].sequence if recent else memory.message_count,
+        "messages": messages,
+        "updated_at": memory.updated_at.isoformat() if memory.updated_at else None
+    }
 
-MAX_MESSAGES_PER_CONVERSATION = 20
 
 class ChatConsumer(AsyncWebsocketConsumer):
     
     @database_sync_to_async
     def get_conversations(self):
         try:
-            memories = AiMemory.objects.filter(user=None).order_by("-updated_at")[:5]
-            conversations = []
-            for memory in memories:
-                # FIXED INDENTATION HERE
-                messages = memory.messages or []
-                if messages:
-                    first_message = messages[0]
-                    title = memory.title or first_message.get('user', '')[:50] + "..." if first_message.get('user') else "New Conversation"
-                else:
-                    title = memory.title or "Empty Conversation"
-                
-                conversations.append({
-                    "id": str(memory.id),
-                    "title": title,
-                    "messages": messages,
-                    "updated_at": memory.updated_at.isoformat() if memory.updated_at else None
-                })
-            return conversations
+            memories = AiMemory.objects.filter(user=self.user).order_by("-updated_at").prefetch_related(recent_entries())[
+                :SNAPSHOT_CONVERSATIONS
+            ]
+            return [conversation_entry(memory) for memory in memories]
         except Exception as e:
             print(f"Error getting conversations: {e}")
             return []
-    
+
+    @database_sync_to_async
+    def get_conversation(self, conversation_id):
+        memory = AiMemory.objects.filter(user=self.user, id=conversation_id).first()
+        return conversation_entry(memory) if memory else None
+
+    async def send_conversation_update(self, mode, payload):
+        with update_serialize_seconds.time():
+            text_data = json.dumps({
+                "type": "conversation_update",
+                "mode": mode,
+                "payload": payload
+            })
+        await self.send(text_data=text_data)
+        # A tab that only listens for updates is still in use
+        self.last_active = asyncio.get_running_loop().time()
+
     async def broadcast_conversations(self):
-        """Broadcast conversation history to client"""
+        """Send a full snapshot of the conversation history to client"""
+        conversations = await self.get_conversations()
+        # The client replaces what it holds with the snapshot
+        self.snapshot = conversations
+        self.revisions = {entry["id"]: entry["revision"] for entry in conversations}
+        await self.send_conversation_update("snapshot", conversations)
+
+    def updated_snapshot(self, change):
+        """The last snapshot with `change` applied, or None if it doesn't follow on from it"""
+        entry = next((entry for entry in self.snapshot if entry["id"] == change["id"]), None)
+        if entry is None:
+            if change["offset"] != 0:
+                return None
+            entry = {"id": change["id"], "title": change["title"], "revision": 0, "offset": 0, "messages": []}
+        follows = entry["offset"] + len(entry["messages"]) == change["offset"]
+        if entry["revision"] != change["revision"] - 1 or not follows:
+            return None
+        messages = entry["messages"] + change["messages"]
+        dropped = max(0, len(messages) - HISTORY_MESSAGES)
+        entry = dict(
+            entry,
+            title=entry_title(change["title"], messages) if not entry["messages"] else entry["title"],
+            revision=change["revision"],
+            offset=entry["offset"] + dropped,
+            messages=messages[dropped:],
+            updated_at=change["updated_at"],
+        )
+        others = [other for other in self.snapshot if other["id"] != change["id"]]
+        return [entry] + others[:SNAPSHOT_CONVERSATIONS - 1]
+
+    async def sync_conversations(self, known):
+        """
+        Send only what the client is missing.
+
+        `known` maps conversation ids to the {"revision", "count"} the client
+        already holds; unknown conversations are sent as their last
+        HISTORY_MESSAGES messages, stale ones as the messages after `count`
+        if those are among them. Updates pushed while the conversations
+        were being read are not sent again.
+        """
+        revisions = dict(self.revisions)
         conversations = await self.get_conversations()
-        await self.send(text_data=json.dumps({
-            "type": "conversation_update",
-            "payload": conversations
-        }))
+        payload = []
+        for entry in conversations:
+            sent = self.revisions.get(entry["id"])
+            if sent != revisions.get(entry["id"]) and sent >= entry["revision"]:
+                continue
+            self.revisions[entry["id"]] = entry["revision"]
+            have = known.get(entry["id"])
+            if not isinstance(have, dict):
+                payload.append(entry)
+                continue
+            if have.get("revision") == entry["revision"]:
+                continue
+            offset = have.get("count")
+            start = entry["offset"]
+            if not isinstance(offset, int) or not start <= offset <= start + len(entry["messages"]):
+                payload.append(entry)
+                continue
+            payload.append({
+                "id": entry["id"],
+                "revision": entry["revision"],
+                "title": entry["title"],
+                "offset": offset,
+                "messages": entry["messages"][offset - start:],
+                "updated_at": entry["updated_at"]
+            })
+        await self.send_conversation_update("delta", payload)
+
+    async def conversations_changed(self, event):
+        change = event["change"]
+        known = self.revisions.get(change["id"])
+        if known is not None and known >= change["revision"]:
+            return
+
+        if not self.deltas:
+            # Clients that never asked for deltas get the whole history, as
+            # before, built from the change unless they missed an earlier one
+            snapshot = self.updated_snapshot(change)
+            if snapshot is None:
+                await self.broadcast_conversations()
+                return
+            self.snapshot = snapshot
+            self.revisions[change["id"]] = change["revision"]
+            await self.send_conversation_update("snapshot", snapshot)
+            return
+
+        if known == change["revision"] - 1 or (known is None and change["offset"] == 0):
+            diff = {
+                "id": change["id"],
+                "revision": change["revision"],
+                "offset": change["offset"],
+                "messages": change["messages"],
+                "updated_at": change["updated_at"]
+            }
+            if known is None:
+                diff["title"] = change["title"]
+        else:
+            # The client missed earlier changes, so send the conversation whole
+            diff = await self.get_conversation(change["id"])
+            if diff is None or self.revisions.get(change["id"], -1) >= diff["revision"]:
+                return
+
+        self.revisions[change["id"]] = diff["revision"]
+        await self.send_conversation_update("delta", [diff])
         
     async def connect(self):
         try:
@@ -50,50 +193,105 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
             channel_hash = hashlib.md5(self.channel_name.encode()).hexdigest()[:8]
             self.room_group_name = f"chat_{channel_hash}"
-            
-            # Start periodic broadcasting (every 3 seconds)
-            self.keep_alive = True
-            asyncio.create_task(self.periodic_broadcast())
+
+            # Authenticated sockets only see their own conversations,
+            # anonymous ones share the conversations stored without a user
+            user = self.scope.get("user")
+            self.user = user if user is not None and user.is_authenticated else None
+            self.conversations_group = conversations_group(self.user.pk if self.user else None)
+
+            # Flow control, see CHAT_LIMITS. Anonymous sockets share a bucket per address
+            self.bucket = connection_bucket()
+            client = self.scope.get("client") or ["unknown"]
+            self.rate_key = f"user:{self.user.pk}" if self.user else f"addr:{client[0]}"
+            self.inbound = asyncio.Queue(LIMITS.get("INBOUND_QUEUE", 8))
+            self.tasks = ConnectionTasks()
+            self.last_active = asyncio.get_running_loop().time()
+
+            if self.scope.get("auth_error"):
+                await self.accept()
+                await self.send_error(self.scope["auth_error"])
+                await self.close(code=4001)
+                return
+
+            # Updates are pushed when a conversation changes, idle sockets cost nothing
+            await self.channel_layer.group_add(self.conversations_group, self.channel_name)
 
             await self.accept()
-            
-            # Send initial conversations immediately
-            await self.broadcast_conversations()
+            self.tasks.start(self.process_messages())
+            self.tasks.start(self.close_when_idle())
+
+            # Send initial conversations immediately, unless the client will sync.
+            # Only clients that sync are sent deltas
+            self.revisions = {}
+            self.snapshot = []
+            self.deltas = b"sync=1" in self.scope.get("query_string", b"").split(b"&")
+            if not self.deltas:
+                await self.broadcast_conversations()
             
         except Exception as e:
             print(f"Connection error: {e}")
             await self.close(code=4000)
 
-    async def periodic_broadcast(self):
-        """Broadcast conversations every 3 seconds"""
-        while self.keep_alive:
-            try:
-                await self.broadcast_conversations()
-                await asyncio.sleep(3)  # Broadcast every 3 seconds
-            except asyncio.CancelledError:
-                break
-            except Exception as e:
-                print(f"Broadcast error: {e}")
-                break
-
     async def disconnect(self, close_code):
         print(f"WebSocket disconnected: {close_code}")
-        self.keep_alive = False
+        if getattr(self, "tasks", None) is not None:
+            await self.tasks.close()
+        await self.channel_layer.group_discard(self.conversations_group, self.channel_name)
 
     async def receive(self, text_data):
+        """Admit a frame to the inbound queue if the rate limits and the queue allow"""
         try:
             data = json.loads(text_data)
-            message_type = data.get("type", "chat_message")
-
-            if message_type == "chat_message":
-                await self.handle_chat_message(data)
-            else:
-                await self.send_error("Unknown message type")
         except json.JSONDecodeError:
             await self.send_error("Invalid JSON format")
-        except Exception as e:
-            print(f"Receive error: {e}")
-            await self.send_error("Internal server error")
+            return
+
+        if not self.bucket.take() or not user_buckets.take(self.rate_key):
+            await self.send_error("Rate limit exceeded, message dropped", code="rate_limited")
+            return
+        try:
+            self.inbound.put_nowait(data)
+        except asyncio.QueueFull:
+            await self.send_error("Too many messages waiting, message dropped", code="queue_full")
+
+    async def process_messages(self):
+        """Handle admitted frames one at a time, in the order they arrived"""
+        while True:
+            data = await self.inbound.get()
+            try:
+                message_type = data.get("type", "chat_message")
+                self.last_active = asyncio.get_running_loop().time()
+
+                if message_type == "ping":
+                    await self.send(text_data=json.dumps({"type": "pong"}))
+                    continue
+
+                if message_type == "chat_message":
+                    await self.handle_chat_message(data)
+                elif message_type == "sync":
+                    self.deltas = True
+                    await self.sync_conversations(data.get("revisions") or {})
+                elif message_type == "resync":
+                    await self.broadcast_conversations()
+                else:
+                    await self.send_error("Unknown message type")
+            except Exception as e:
+                print(f"Receive error: {e}")
+                await self.send_error("Internal server error")
+
+    async def close_when_idle(self):
+        """Close the socket once it has neither sent a message nor been sent an update for IDLE_TIMEOUT seconds"""
+        if not IDLE_TIMEOUT:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = self.last_active + IDLE_TIMEOUT - loop.time()
+            if remaining <= 0:
+                print("Closing idle WebSocket")
+                await self.close(code=4011)
+                return
+            await asyncio.sleep(remaining)
 
     async def handle_chat_message(self, data):
         user_message = data.get("message", "").strip()
@@ -102,72 +300,42 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send_error("Message cannot be empty")
             return
 
-        # Generate AI response
-        ai_response = await self.generate_ai_response(user_message)
+        async def send_reply(result):
+            await self.send(text_data=json.dumps({
+                "type": "chat_response",
+                "user_message": user_message,
+                "ai_response": result.reply,
+                "timestamp": asyncio.get_event_loop().time(),
+                "conversation_id": result.change["id"] if result.change else None
+            }))
 
-        # Save to database (without user)
-        conversation_id = await self.save_conversation(user_message, ai_response)
+        async def send_chunk(chunk):
+            await self.send(text_data=json.dumps({
+                "type": "chat_response_chunk",
+                "delta": chunk
+            }))
 
-        # Send AI response
-        response_data = {
-            "type": "chat_response",
-            "user_message": user_message,
-            "ai_response": ai_response,
-            "timestamp": asyncio.get_event_loop().time(),
-            "conversation_id": conversation_id
-        }
-        await self.send(text_data=json.dumps(response_data))
-        
-        await asyncio.sleep(0.1)
-        
-        # Immediately update conversations after new message
-        await self.broadcast_conversations()
+        async def send_end(result):
+            await self.send(text_data=json.dumps({
+                "type": "chat_response_end",
+                "user_message": user_message,
+                "timestamp": asyncio.get_event_loop().time(),
+                "conversation_id": result.change["id"] if result.change else None
+            }))
 
-    async def generate_ai_response(self, user_message: str):
-        """
-        Delegate AI response generation to the ResponseHandler (and MathHandler internally).
-        """
-        try:
-            response = ResponseHandler.process(user_message)
-            return response or "I'm still learning, but I got your message."
-        except Exception as e:
-            print(f"AI Response error: {e}")
-            return "Something went wrong while generating a response."
-    
-    @database_sync_to_async
-    def save_conversation(self, user_message, ai_response):
-        try:
-            chat = UserChat.objects.create(
-                user=None,
-                message=user_message
-            )
-
-            VictorAi.objects.create(
-                user_chat=chat,
-                response=ai_response
-            )
-
-            latest_memory = AiMemory.objects.filter(user=None).order_by('-id').first()
-
-            if not latest_memory or len(latest_memory.messages) >= MAX_MESSAGES_PER_CONVERSATION:
-                memory = AiMemory.objects.create(
-                    user=None,
-                    title=user_message[:50] + "..." if len(user_message) > 50 else user_message,
-                    messages=[{"user": user_message, "ai": ai_response}]
-                )
-            else:
-                latest_memory.messages.append({"user": user_message, "ai": ai_response})
-                latest_memory.save()
-                memory = latest_memory
-            memory.refresh_from_db()
-            return str(memory.id)
-        
-        except Exception as e:
-            print(f"Database save error: {e}")
-            return None
+        # Generate, store and publish the turn, the reply goes out before the update
+        if data.get("stream"):
+            result = await turns.run_stream(self.user, user_message, send_chunk, deliver=send_end)
+        else:
+            result = await turns.run(self.user, user_message, deliver=send_reply)
+        if result is None:
+            await self.send_error("Server is busy, please try again")
 
-    async def send_error(self, error_message):
-        await self.send(text_data=json.dumps({
+    async def send_error(self, error_message, code=None):
+        error = {
             "type": "error",
             "message": error_message
-        }))
\ No newline at end of file
+        }
+        if code:
+            error["code"] = code
+        await self.send(text_data=json.dumps(error))
\ No newline at end of file
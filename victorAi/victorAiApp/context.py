@@ -0,0 +1,100 @@
+# context.py
+import re
+from django.conf import settings
+from .models import AiMemory
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text: str) -> int:
+    """Rough token count: words and punctuation marks."""
+    return len(_TOKEN_RE.findall(text))
+
+
+def message_tokens(content: dict) -> int:
+    return count_tokens(content.get("user", "")) + count_tokens(content.get("ai", ""))
+
+
+class ContextBuilder:
+    """
+    Assembles what a generator gets to see of a conversation: a running
+    summary of the older turns plus the most recent turns verbatim, within
+    `max_tokens`.
+
+    Only the messages after AiMemory.summary_upto are ever read. When they
+    outgrow their share of the budget the oldest are folded into the summary
+    and summary_upto moves past them, so each build reads the recent tail
+    plus whatever arrived since, never the whole history. Folding goes down
+    to half the budget so it happens every few turns rather than every turn.
+    """
+
+    def __init__(self, max_tokens=1024, summary_tokens=256, line_tokens=24):
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.line_tokens = line_tokens
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, "CHAT_CONTEXT", {})
+        return cls(
+            max_tokens=config.get("MAX_TOKENS", 1024),
+            summary_tokens=config.get("SUMMARY_TOKENS", 256),
+        )
+
+    def for_user(self, user):
+        """Context of the user's latest conversation, or None if there is none."""
+        memory = AiMemory.objects.filter(user=user).order_by("-id").first()
+        return self.build(memory) if memory else None
+
+    def build(self, memory: AiMemory) -> dict:
+        tail = list(
+            memory.entries.filter(sequence__gte=memory.summary_upto).values_list("sequence", "content")
+        )
+        sizes = [message_tokens(content) for _, content in tail]
+        budget = self.max_tokens - self.summary_tokens
+
+        if sum(sizes) > budget:
+            # Keep the newest turns that fit in half the budget, always at least one
+            kept, fold = 0, len(tail)
+            while fold > 1 and kept + sizes[fold - 1] <= budget // 2:
+                fold -= 1
+                kept += sizes[fold]
+            fold = min(fold, len(tail) - 1)
+            if fold:
+                self.compact(memory, [content for _, content in tail[:fold]], tail[fold - 1][0] + 1)
+                tail = tail[fold:]
+
+        return {
+            "summary": memory.summary,
+            "messages": [content for _, content in tail],
+        }
+
+    def compact(self, memory, contents, upto):
+        """Fold `contents` into the summary and store it unless another builder got there first."""
+        summary = self.summarize(memory.summary, contents)
+        updated = AiMemory.objects.filter(pk=memory.pk, summary_upto=memory.summary_upto).update(
+            summary=summary, summary_upto=upto
+        )
+        if updated:
+            memory.summary, memory.summary_upto = summary, upto
+        else:
+            memory.refresh_from_db(fields=["summary", "summary_upto"])
+
+    def summarize(self, summary, contents):
+        """
+        Extractive summary: one shortened line per folded turn, dropping the
+        oldest lines once over `summary_tokens`.
+        """
+        lines = summary.splitlines() if summary else []
+        for content in contents:
+            lines.append(f"User: {self.shorten(content.get('user', ''))} | AI: {self.shorten(content.get('ai', ''))}")
+        while len(lines) > 1 and count_tokens("\n".join(lines)) > self.summary_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def shorten(self, text):
+        limit = self.line_tokens // 2
+        tokens = list(_TOKEN_RE.finditer(text))
+        if len(tokens) <= limit:
+            return text
+        return text[:tokens[limit - 1].end()] + "..."
@@ -0,0 +1,201 @@
+# generation.py
+import asyncio
+import multiprocessing
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from .metrics import registry
+
+
+class PoolSaturated(Exception):
+    """Raised when too many generations are already waiting for the pool."""
+
+
+class GenerationPool:
+    """
+    Runs response generation off the event loop.
+
+    `executor` is "inline" (on the loop, as before), "thread" or "process".
+    Only a process pool can stop a runaway generation: when one times out the
+    pool is restarted with fresh workers and the other calls it was running
+    or holding are submitted again, with a full timeout on the new pool. The
+    same happens when a worker dies, e.g. killed for running out of memory,
+    except that a call whose pool broke twice fails with BrokenProcessPool
+    rather than being tried a third time. A timed out thread keeps running in the background until it
+    finishes and counts as pending until then.
+
+    At most `max_pending` generations may be running or queued; further calls
+    raise PoolSaturated instead of growing the queue. `initializer` runs in
+    every new worker, start() launches the workers ahead of the first call.
+    """
+
+    def __init__(self, executor="thread", workers=2, timeout=2.0, max_pending=64, initializer=None):
+        self.mode = executor
+        self.workers = workers
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.initializer = initializer
+        self.executor = None
+        self.pending = 0
+        # Calls submitted to a process pool and not answered yet, by their
+        # future, as [func, args, pools broken under them]
+        self.inflight = {}
+        self.restarts = 0
+        self.restarted_at = None
+
+    @classmethod
+    def from_settings(cls):
+        config = getattr(settings, "CHAT_GENERATION", {})
+        return cls(
+            executor=config.get("EXECUTOR", "thread"),
+            workers=config.get("WORKERS", 2),
+            timeout=config.get("TIMEOUT", 2.0),
+            max_pending=config.get("MAX_PENDING", 64),
+            initializer=init_worker,
+        )
+
+    @property
+    def queue_depth(self):
+        """Generations waiting for a free worker."""
+        return max(0, self.pending - self.workers)
+
+    def start(self):
+        if self.executor is not None:
+            return
+        if self.mode == "process":
+            # spawn, as forking a process that already runs threads is unsafe
+            self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"), initializer=self.initializer
+            )
+            # Workers are only launched for submitted calls, so launch them all now
+            for _ in range(self.workers):
+                self.executor.submit(int)
+        elif self.mode == "thread":
+            self.executor = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="generation", initializer=self.initializer
+            )
+
+    def restart(self, broken=False):
+        executor, self.executor = self.executor, None
+        if executor is None:
+            return
+        if isinstance(executor, ProcessPoolExecutor):
+            for process in list((executor._processes or {}).values()):
+                process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.restarts += 1
+        self.restarted_at = asyncio.get_running_loop().time()
+        self.start()
+        for outcome, call in list(self.inflight.items()):
+            func, args, breaks = call
+            if broken:
+                call[2] = breaks = breaks + 1
+            if breaks >= 2:
+                # Probably the call that keeps killing its worker
+                del self.inflight[outcome]
+                if not outcome.done():
+                    outcome.set_exception(BrokenProcessPool("A worker died twice while running this call"))
+            else:
+                self.submit(outcome, func, args)
+
+    def submit(self, outcome, func, args):
+        """Run func(*args) in the current executor and settle `outcome` with its result."""
+        executor = self.executor
+        try:
+            task = executor.submit(func, *args)
+        except BrokenExecutor:
+            if outcome not in self.inflight:
+                raise
+            # A worker died while the pool was idle; the restart submits this call again
+            self.restart()
+            return None
+        loop = outcome.get_loop()
+        task.add_done_callback(lambda _: loop.call_soon_threadsafe(self.settle, executor, outcome, task))
+        return task
+
+    def settle(self, executor, outcome, task):
+        if outcome.done():
+            return
+        if executor is not self.executor and (task.cancelled() or isinstance(task.exception(), BrokenExecutor)):
+            # Killed by a restart, the call was submitted to the new pool
+            return
+        if task.cancelled():
+            outcome.cancel()
+        elif isinstance(task.exception(), BrokenProcessPool) and outcome in self.inflight:
+            # A worker died, which breaks the whole pool
+            self.restart(broken=True)
+        elif task.exception() is not None:
+            outcome.set_exception(task.exception())
+        else:
+            outcome.set_result(task.result())
+
+    async def run(self, func, *args):
+        """Call func(*args) in the pool, raising asyncio.TimeoutError past the timeout."""
+        if self.pending >= self.max_pending:
+            generation_rejected.inc()
+            raise PoolSaturated()
+
+        self.pending += 1
+        release = True
+        try:
+            if self.mode == "inline":
+                result = func(*args)
+            else:
+                self.start()
+                loop = asyncio.get_running_loop()
+                outcome = loop.create_future()
+                if self.mode == "process":
+                    self.inflight[outcome] = [func, args, 0]
+                task = self.submit(outcome, func, args)
+                try:
+                    result = await self.wait(outcome)
+                except asyncio.TimeoutError:
+                    generation_timeouts.inc()
+                    if self.mode == "process":
+                        del self.inflight[outcome]
+                        self.restart()
+                    else:
+                        # The thread runs on, so it keeps its slot until it ends
+                        release = False
+                        task.add_done_callback(lambda _: loop.call_soon_threadsafe(self.release))
+                    raise
+                finally:
+                    self.inflight.pop(outcome, None)
+            generation_completed.inc()
+            return result
+        finally:
+            if release:
+                self.release()
+
+    async def wait(self, outcome):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        while True:
+            restarts = self.restarts
+            try:
+                return await asyncio.wait_for(asyncio.shield(outcome), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                if self.restarts != restarts:
+                    # Submitted again after a restart, the new pool gets the full timeout
+                    deadline = self.restarted_at + self.timeout
+                    if deadline > loop.time():
+                        continue
+                outcome.cancel()
+                raise
+
+    def release(self):
+        self.pending -= 1
+
+
+def init_worker():
+    """Set up a new worker: share its metrics and load the intents before its first call."""
+    from .handlers import intents
+
+    registry.start()
+    intents.current()
+
+
+_calls = registry.counter("chat_generation_calls_total", "Generation pool calls, by outcome", ["outcome"])
+generation_completed = _calls.labels(outcome="completed")
+generation_timeouts = _calls.labels(outcome="timeout")
+generation_rejected = _calls.labels(outcome="rejected")
@@ -1,65 +1,321 @@
-import random
+import ast
+import functools
+import json
 import math
+import operator
+import os
+import random
 import re
+import threading
+import time
+from .metrics import messages_total, registry
 
-PROMPTS = {
-    "what are you": "I am Victor's first Artificial Intelligence, V1",
-    "built you": "Akinola Victor is the visionary behind VictorAi, launching its first version, V1, to assist and interact intelligently.",
-    "founder": "Do you want to know the founder of something?",
-    "okay": "Glad to meet you too! See you soon 👋",
-    "akinola victor": "Akinola Victor is the visionary behind VictorAi, launching its first version, V1, to assist and interact intelligently.",
-    "story": "Sure, what story would you like?",
-    "stories": "Sure, what story would you like?",
-    "joke": "I love jokes too! Do you want me to crack one for you? 😎😁",
-    "jokes": "I love jokes too! Do you want me to crack one for you? 😎😁",
-    "machine learning": "Machine learning is a branch of AI that allows systems to learn from data and improve over time without being explicitly programmed.",
-    "wassup": "Hi, wassup? How can I help you today?",
-    "what is an ai chatbot": "An AI chatbot is a software program that uses artificial intelligence to simulate human conversation, understanding natural language to respond to user queries in a human-like way",
-    "is url":"A URL (Uniform Resource Locator) is a web address that serves as a unique identifier and a global address for a specific resource, document, or page on the internet",
-    "a url":"A URL (Uniform Resource Locator) is a web address that serves as a unique identifier and a global address for a specific resource, document, or page on the internet",
-    "default": "I'm still learning, but I got your message.",
-    
-}
+# Where the greetings, goodbyes and prompts live. Each process reloads the
+# file on its own when it changes, checking at most every RELOAD_INTERVAL.
+INTENTS_FILE = os.getenv("INTENTS_FILE", os.path.join(os.path.dirname(__file__), "intents.json"))
+INTENTS_RELOAD_INTERVAL = float(os.getenv("INTENTS_RELOAD_INTERVAL", "2"))
 
-GREETINGS = {
-    "hi": [
-        "Hi there! How is it going?",
-        "Hey! Hope you’re doing well."
-    ],
-    "hello": [
-        "Hello there! How can I help you today?",
-        "Hello there! How are you doing today?"
-    ],
-    "hey": [
-        "Hi, how are you doing today?",
-        "Hey! What’s up?"
-    ],
-    "good morning": [
-        "Good Morning, How are you doing?",
-        "Good Morning! Hope your day goes great!"
-    ],
-    "how are you": [
-        "I'm just code, but I'm doing great 😄"
-    ],
-    "hi chatbot": [
-        "I'm just code, but I'm doing great 😄"
-    ]
-}
 
-GOODBYES = {
-    "bye": [
-        "Goodbye! Have a great day!",
-        "Bye-bye! Take care!"
-    ],
-    "goodbye": [
-        "Take care, see you soon!",
-        "Goodbye! Until next time!"
-    ],
-    "see you": [
-        "See you later 👋",
-        "Catch you later!"
-    ]
-}
+# ---------------- INTENT MATCHER ----------------
+_TOKEN_RE = re.compile(r"\w+|\W")
+
+
+def _is_word_char(char: str) -> bool:
+    """Whether char matches \w, without a regex call."""
+    return char.isalnum() or char == "_"
+
+
+class IntentMatcher:
+    """
+    Finds every intent key in a message in a single pass.
+
+    Keys only match on word boundaries, as with rf"\b{key}\b", so a match
+    always starts and ends on a whole word token; a key starting or ending
+    in punctuation, like "c++", also needs a word character on that side.
+    Keys are indexed by their first token along with the
+    longest key starting with it; the message is walked token by token and
+    only spans that could be a key are looked up. Building the index costs a
+    dict insert and a few string method calls per key, with a regex match
+    only for keys whose first word holds punctuation: about 5-6 ms for 10k
+    keys, 8-9 ms with loading the JSON file, paid by the message that
+    notices the file changed.
+    """
+
+    def __init__(self, keys):
+        self.keys = {}
+        self.heads = {}
+        # Keys starting or ending in punctuation: whether they need a word character before and after
+        self.bounded = {}
+        # This runs on every reload, so it sticks to string methods where it can
+        for index, key in enumerate(keys):
+            key = key.strip()
+            if not key:
+                continue
+            hits = self.keys.get(key)
+            if hits is None:
+                self.keys[key] = [index]
+            else:
+                hits.append(index)
+            head = key.split(" ", 1)[0]
+            if not head.isalnum():
+                head = _TOKEN_RE.match(key).group()
+            if len(key) > self.heads.get(head, 0):
+                self.heads[head] = len(key)
+            first, last = key[0], key[-1]
+            before = not (first.isalnum() or first == "_")
+            after = not (last.isalnum() or last == "_")
+            if before or after:
+                self.bounded[key] = (before, after)
+
+    def find(self, text: str) -> list[int]:
+        """Return the indices of the keys found in text, in key order."""
+        spans = [match.span() for match in _TOKEN_RE.finditer(text)]
+        count = len(spans)
+        found = set()
+        for first in range(count):
+            start, end = spans[first]
+            longest = self.heads.get(text[start:end])
+            if longest is None:
+                continue
+            limit = start + longest
+            for last in range(first, count):
+                end = spans[last][1]
+                if end > limit:
+                    break
+                hits = self.keys.get(text[start:end])
+                if hits and (not self.bounded or self.bounded_match(text, start, end)):
+                    found.update(hits)
+        return sorted(found)
+
+    def bounded_match(self, text: str, start: int, end: int) -> bool:
+        before, after = self.bounded.get(text[start:end], (False, False))
+        if before and not (start and _is_word_char(text[start - 1])):
+            return False
+        if after and not (end < len(text) and _is_word_char(text[end])):
+            return False
+        return True
+
+
+class IntentTable:
+    """
+    The intent tables compiled for matching, with an LRU cache of the
+    intents found per normalized message.
+
+    Only the matched intent indices are cached; reply variants are still
+    picked with random.choice on every call. Messages longer than
+    CACHE_KEY_LENGTH are matched without the cache, so a few huge messages
+    can't pin megabytes of keys. Replacing the table replaces its cache, so
+    reloaded intents never see stale matches.
+    """
+
+    CACHE_SIZE = 4096
+    CACHE_KEY_LENGTH = 512
+
+    def __init__(self, greetings, goodbyes, prompts):
+        self.greetings = greetings
+        self.goodbyes = goodbyes
+        self.prompts = prompts
+
+        # Flattened in the order their replies are joined
+        self.intents = list(greetings.items())
+        self.intents += goodbyes.items()
+        self.intents += [(key, reply) for key, reply in prompts.items() if key != "default"]
+        self.matcher = IntentMatcher(key for key, _ in self.intents)
+        self.cache = functools.lru_cache(maxsize=self.CACHE_SIZE)(self._find)
+
+    def find(self, normalized: str) -> tuple[int, ...]:
+        if len(normalized) > self.CACHE_KEY_LENGTH:
+            return self._find(normalized)
+        return self.cache(normalized)
+
+    def _find(self, normalized: str) -> tuple[int, ...]:
+        return tuple(self.matcher.find(normalized))
+
+    def replies(self, text_lower: str) -> list[str]:
+        """Return the replies of every intent found in the lowercased text."""
+        return self.pick(self.find(text_lower.strip()))
+
+    def pick(self, found) -> list[str]:
+        """Return a reply for each of the `found` intent indices."""
+        responses = []
+        for index in found:
+            reply = self.intents[index][1]
+            responses.append(random.choice(reply) if isinstance(reply, list) else reply)
+        return responses
+
+    def category(self, found) -> str | None:
+        """"greeting", "goodbye" or "prompt": the table of the first of the `found` intents."""
+        if not found:
+            return None
+        if found[0] < len(self.greetings):
+            return "greeting"
+        if found[0] < len(self.greetings) + len(self.goodbyes):
+            return "goodbye"
+        return "prompt"
+
+    def cache_info(self) -> dict:
+        info = self.cache.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
+
+    @classmethod
+    def from_file(cls, path: str) -> "IntentTable":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data.get("greetings", {}), data.get("goodbyes", {}), data["prompts"])
+
+
+class IntentStore:
+    """
+    Holds the live IntentTable and swaps in a freshly compiled one whenever
+    the intents file changes on disk.
+
+    A new table is fully built before it replaces the old one, so messages
+    being handled meanwhile keep matching against a complete table, and a
+    broken file is reported and ignored rather than taking the old table
+    down. Cache counters are carried over swaps.
+    """
+
+    def __init__(self, path, reload_interval=2.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.retired = {"hits": 0, "misses": 0}
+        self.mtime = os.stat(path).st_mtime_ns
+        self.table = IntentTable.from_file(path)
+        self.checked_at = time.monotonic()
+
+    def current(self) -> IntentTable:
+        """Return the live table, reloading it first if the file has changed."""
+        if time.monotonic() - self.checked_at >= self.reload_interval:
+            self.reload()
+        return self.table
+
+    def reload(self, force=False) -> bool:
+        """Swap in the intents file if it changed since it was loaded."""
+        with self.lock:
+            self.checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self.mtime and not force:
+                    return False
+                # Remember the failed version too, so it isn't retried on every check
+                self.mtime = mtime
+                table = IntentTable.from_file(self.path)
+            except (OSError, ValueError, KeyError, AttributeError) as e:
+                print(f"Intent reload error: {e}")
+                return False
+
+            info = self.table.cache_info()
+            self.retired["hits"] += info["hits"]
+            self.retired["misses"] += info["misses"]
+            self.table = table
+            self.reloads += 1
+            return True
+
+    def stats(self) -> dict:
+        info = self.table.cache_info()
+        return {
+            "intents": len(self.table.intents),
+            "reloads": self.reloads,
+            "cache_hits": self.retired["hits"] + info["hits"],
+            "cache_misses": self.retired["misses"] + info["misses"],
+            "cache_size": info["size"],
+        }
+
+
+intents = IntentStore(INTENTS_FILE, INTENTS_RELOAD_INTERVAL)
+
+registry.counter_function(
+    "chat_intent_cache_hits_total", "Intent lookups answered from the cache", lambda: intents.stats()["cache_hits"]
+)
+registry.counter_function(
+    "chat_intent_cache_misses_total", "Intent lookups matched and added to the cache",
+    lambda: intents.stats()["cache_misses"],
+)
+
+
+def match_intents(text_lower: str) -> list[str]:
+    """Return the replies of every intent found in the lowercased text."""
+    return intents.current().replies(text_lower)
+
+
+def default_reply() -> str:
+    return intents.current().prompts.get("default", "")
+
+
+# ---------------- CALCULATOR ----------------
+class Calculator:
+    """
+    Evaluates arithmetic without eval().
+
+    Expressions are parsed once into an AST and walked with hard limits on
+    length, operand size and steps, so hostile input fails fast instead of
+    burning CPU. Results, including failures, are memoized per expression.
+    """
+    MAX_LENGTH = 200
+    MAX_MAGNITUDE = 10 ** 18
+    MAX_STEPS = 100
+
+    BINARY = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+    }
+    UNARY = {
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+    }
+
+    class Error(ValueError):
+        pass
+
+    @classmethod
+    def evaluate(cls, expr: str):
+        """Return the value of expr, or None if it is invalid or over a limit."""
+        # Checked before the cache, so overlong input is never kept as a key
+        if len(expr) > cls.MAX_LENGTH:
+            return None
+        return cls._evaluate(expr)
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def _evaluate(cls, expr: str):
+        try:
+            tree = ast.parse(expr, mode="eval")
+            return cls._eval(tree.body, [cls.MAX_STEPS])
+        except (SyntaxError, ArithmeticError, cls.Error):
+            return None
+
+    @classmethod
+    def _eval(cls, node, budget):
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise cls.Error("too many steps")
+
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return cls._check(node.value)
+        if isinstance(node, ast.UnaryOp) and type(node.op) in cls.UNARY:
+            return cls.UNARY[type(node.op)](cls._eval(node.operand, budget))
+        if isinstance(node, ast.BinOp) and type(node.op) in cls.BINARY:
+            left = cls._eval(node.left, budget)
+            right = cls._eval(node.right, budget)
+            if isinstance(node.op, ast.Pow) and abs(left) > 1:
+                # Refuse before computing anything too large to hold
+                if abs(right) * math.log10(abs(left)) > math.log10(cls.MAX_MAGNITUDE):
+                    raise cls.Error("result too large")
+            return cls._check(cls.BINARY[type(node.op)](left, right))
+        raise cls.Error("unsupported expression")
+
+    @classmethod
+    def _check(cls, value):
+        if isinstance(value, complex) or not abs(value) <= cls.MAX_MAGNITUDE:
+            raise cls.Error("operand too large")
+        return value
 
 
 # ---------------- MATH HANDLER ----------------
@@ -89,10 +345,7 @@ class MathHandler:
             return None
         expr = expr.strip()
         if re.match(r"^[0-9\+\-\*/\.\%\(\) ]+$", expr):
-            try:
-                return eval(expr, {"__builtins__": None, "math": math}, {})
-            except Exception:
-                return None
+            return Calculator.evaluate(expr)
         return None
 
     @classmethod
@@ -103,28 +356,20 @@ class MathHandler:
         if result is None:
             return None
 
-        responses = []
-
-        # greetings
-        for key, variants in GREETINGS.items():
-            if re.search(rf"\b{re.escape(key)}\b", text.lower()):
-                responses.append(random.choice(variants))
-
-        # goodbyes
-        for key, variants in GOODBYES.items():
-            if re.search(rf"\b{re.escape(key)}\b", text.lower()):
-                responses.append(random.choice(variants))
-
-        # prompts
-        for key, reply in PROMPTS.items():
-            if key != "default" and re.search(rf"\b{re.escape(key)}\b", text.lower()):
-                responses.append(reply)
+        # greetings, goodbyes and prompts
+        responses = match_intents(text.lower())
 
         responses.append(f"The result of {expr} is {result}.")
         return " ".join(responses)
 
 
 # ---------------- RESPONSE HANDLER ----------------
+# Messages answered, by the kind of intent that answered them
+_answered = {
+    intent: messages_total.labels(intent=intent) for intent in ("math", "greeting", "goodbye", "prompt", "default")
+}
+
+
 class ResponseHandler:
     @staticmethod
     def process(text: str):
@@ -134,25 +379,19 @@ class ResponseHandler:
         if any(ch.isdigit() for ch in text_lower) or any(op in text_lower for op in ["+", "-", "*", "x", "/", "plus", "minus", "times", "divide", 'divided by']):
             math_resp = MathHandler.process(text)
             if math_resp:
+                _answered["math"].inc()
                 return math_resp
 
-        responses = []
-
-        # greetings
-        for key, variants in GREETINGS.items():
-            if re.search(rf"\b{re.escape(key)}\b", text_lower):
-                responses.append(random.choice(variants))
+        # greetings, goodbyes and prompts, from one table even if it is reloaded meanwhile
+        table = intents.current()
+        found = table.find(text_lower.strip())
 
-        # goodbyes
-        for key, variants in GOODBYES.items():
-            if re.search(rf"\b{re.escape(key)}\b", text_lower):
-                responses.append(random.choice(variants))
+        if found:
+            _answered[table.category(found)].inc()
+            return " ".join(table.pick(found))
+        _answered["default"].inc()
+        return table.prompts.get("default", "")
 
-        # prompts
-        for key, reply in PROMPTS.items():
-            if key != "default" and re.search(rf"\b{re.escape(key)}\b", text_lower):
-                responses.append(reply)
-
-        if responses:
-            return " ".join(responses)
-        return PROMPTS["default"]
+    @staticmethod
+    def process_batch(texts: list[str]) -> list[str]:
+        return [ResponseHandler.process(text) for text in texts]
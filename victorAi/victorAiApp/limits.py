@@ -0,0 +1,57 @@
+# limits.py
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+LIMITS = getattr(settings, "CHAT_LIMITS", {})
+
+
+class TokenBucket:
+    """Allows `rate` events per second on average, in bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class BucketRegistry:
+    """
+    Token buckets shared by every connection with the same key, e.g. all the
+    sockets of one user in this process. Only the `max_size` most recently
+    used buckets are kept; an evicted bucket comes back full, which only ever
+    errs on the side of letting a message through.
+    """
+
+    def __init__(self, rate, burst, max_size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+
+    def take(self, key) -> bool:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+            if len(self.buckets) > self.max_size:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take()
+
+
+def connection_bucket():
+    return TokenBucket(LIMITS.get("CONNECTION_RATE", 1.0), LIMITS.get("CONNECTION_BURST", 5))
+
+
+user_buckets = BucketRegistry(LIMITS.get("USER_RATE", 2.0), LIMITS.get("USER_BURST", 10))
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import sys
+import time
+from django.core.management.base import BaseCommand
+from victorAiApp.broker import PubSubBroker
+
+GROUP = "bench_workers"
+MESSAGES = ["hello", "what is 12 * 7", "tell me a joke", "see you later", "what are you"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure channel layer throughput with several worker processes. Each "
+        "worker joins a shared group, waits for a start signal sent to that group "
+        "(checking cross-process fan-out), then handles chat messages through the "
+        "layer. Uses the local broker unless --redis-url points at a Redis server."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Worker counts to compare")
+        parser.add_argument("--messages", type=int, default=2000, help="Messages handled by each worker")
+        parser.add_argument("--redis-url", help="Use this Redis server instead of the local broker")
+        parser.add_argument("--layer", choices=["redis", "redis-pubsub"], default="redis-pubsub")
+        parser.add_argument("--worker", help="Internal: run a worker reporting to this channel")
+
+    def handle(self, *args, **options):
+        if options["worker"]:
+            return asyncio.run(self.run_worker(options["worker"], options["messages"]))
+        asyncio.run(self.run_benchmark(options))
+
+    async def run_benchmark(self, options):
+        from channels_redis.core import RedisChannelLayer
+        from channels_redis.pubsub import RedisPubSubChannelLayer
+
+        server = None
+        url = options["redis_url"]
+        if url is None:
+            server = await PubSubBroker().start("127.0.0.1", 0)
+            url = "redis://127.0.0.1:%d" % server.sockets[0].getsockname()[1]
+            if options["layer"] != "redis-pubsub":
+                self.stderr.write("The local broker only supports --layer redis-pubsub")
+                return
+
+        layer_class = RedisChannelLayer if options["layer"] == "redis" else RedisPubSubChannelLayer
+        layer = layer_class(hosts=[url])
+        env = {**os.environ, "CHANNEL_LAYER": options["layer"], "REDIS_URL": url}
+
+        self.stdout.write(f"{'workers':>8}{'messages':>10}{'seconds':>10}{'msg/s':>10}{'speedup':>9}")
+        baseline = None
+        for count in options["workers"]:
+            coordinator = await layer.new_channel()
+            workers = [
+                await asyncio.create_subprocess_exec(
+                    sys.executable, sys.argv[0], "bench_channel_layer",
+                    "--worker", coordinator, "--messages", str(options["messages"]), env=env,
+                )
+                for _ in range(count)
+            ]
+
+            for _ in range(count):
+                await layer.receive(coordinator)
+            await layer.group_send(GROUP, {"type": "bench.start"})
+
+            results = [await layer.receive(coordinator) for _ in range(count)]
+            for worker in workers:
+                await worker.wait()
+
+            messages = sum(result["messages"] for result in results)
+            seconds = max(result["seconds"] for result in results)
+            rate = messages / seconds
+            baseline = baseline or rate / count
+            self.stdout.write(f"{count:>8}{messages:>10}{seconds:>10.2f}{rate:>10.0f}{rate / baseline:>9.2f}")
+
+        await layer.flush()
+        if server is not None:
+            server.close()
+
+    async def run_worker(self, coordinator, messages):
+        from channels.layers import get_channel_layer
+        from victorAiApp.handlers import ResponseHandler
+
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(GROUP, channel)
+        await layer.send(coordinator, {"type": "bench.ready"})
+        await layer.receive(channel)
+
+        started = time.perf_counter()
+        for index in range(messages):
+            reply = ResponseHandler.process(MESSAGES[index % len(MESSAGES)])
+            await layer.send(channel, {"type": "chat.response", "reply": reply})
+            await layer.receive(channel)
+        seconds = time.perf_counter() - started
+
+        await layer.send(coordinator, {"type": "bench.done", "messages": messages, "seconds": seconds})
+        await layer.group_discard(GROUP, channel)
+        await layer.flush()
@@ -0,0 +1,72 @@
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from django.core.management.base import BaseCommand
+
+# Environment applied on top of the current one for each database profile
+PROFILES = {
+    "sqlite-default": {"DATABASE_ENGINE": "sqlite", "SQLITE_TUNED": "False", "DB_CONN_MAX_AGE": "0"},
+    "sqlite-tuned": {"DATABASE_ENGINE": "sqlite", "SQLITE_TUNED": "True"},
+    "postgresql": {"DATABASE_ENGINE": "postgresql"},
+    "postgresql-pool": {"DATABASE_ENGINE": "postgresql", "DB_POOL": "True"},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure chat turn write throughput under each database profile. "
+        "SQLite profiles use a throwaway database file; PostgreSQL profiles write "
+        "to the database configured by the POSTGRES_* variables."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profiles", nargs="+", default=["sqlite-default", "sqlite-tuned"], choices=sorted(PROFILES))
+        parser.add_argument("--writers", type=int, default=4, help="Concurrent writer processes")
+        parser.add_argument("--turns", type=int, default=200, help="Turns saved by each writer")
+        parser.add_argument("--worker", action="store_true", help="Internal: run a single writer")
+
+    def handle(self, *args, **options):
+        if options["worker"]:
+            return self.run_worker(options["turns"])
+
+        self.stdout.write(f"{'profile':<16}{'turns':>8}{'errors':>8}{'seconds':>10}{'turns/s':>10}")
+        for profile in options["profiles"]:
+            with tempfile.TemporaryDirectory() as directory:
+                env = {**os.environ, **PROFILES[profile], "SQLITE_PATH": os.path.join(directory, "bench.sqlite3")}
+                self.manage(env, "migrate", "--skip-checks", "--verbosity", "0").check_returncode()
+
+                writers = [
+                    self.manage(env, "bench_db", "--worker", "--turns", str(options["turns"]), wait=False)
+                    for _ in range(options["writers"])
+                ]
+                # Each writer reports "<errors> <seconds>" on its last line
+                results = [writer.communicate()[0].split()[-2:] for writer in writers]
+                errors = sum(int(result[0]) for result in results)
+                elapsed = max(float(result[1]) for result in results)
+
+            turns = options["writers"] * options["turns"]
+            self.stdout.write(f"{profile:<16}{turns:>8}{errors:>8}{elapsed:>10.2f}{(turns - errors) / elapsed:>10.1f}")
+
+    def manage(self, env, *args, wait=True):
+        command = [sys.executable, sys.argv[0], *args]
+        if wait:
+            return subprocess.run(command, env=env)
+        return subprocess.Popen(command, env=env, stdout=subprocess.PIPE, text=True)
+
+    def run_worker(self, turns):
+        from victorAiApp.services import turns as pipeline
+
+        async def run():
+            errors = 0
+            for index in range(turns):
+                change = await pipeline.persist(None, f"benchmark message {index}", "benchmark reply")
+                errors += change is None
+            return errors
+
+        started = time.perf_counter()
+        errors = asyncio.run(run())
+        self.stdout.write(f"{errors} {time.perf_counter() - started}")
@@ -0,0 +1,169 @@
+import json
+import math
+import platform
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from victorAiApp.handlers import Calculator, IntentTable, MathHandler, ResponseHandler, intents
+
+# Words that pad messages and start the synthetic intents of scaled tables
+FILLER = (
+    "the a to and of my you is it for on with that this can what how please about really just "
+    "today some me your weather music football coffee movie project weekend code python garden "
+    "travel book dinner work friend idea question problem help thanks again still"
+).split()
+OPERATORS = ["+", "-", "*", "/", "plus", "minus", "times", "divided by"]
+
+TARGETS = ["ResponseHandler.process", "MathHandler.process", "MathHandler._normalize", "generate_ai_reply"]
+
+
+def build_corpus(table, size, hit_rate, math_rate, rng):
+    """
+    Messages of roughly log-normal length (median 8 words). `hit_rate` of them
+    contain an intent key of `table`, `math_rate` an arithmetic question, the
+    rest neither.
+    """
+    keys = [key for key, _ in table.intents]
+    corpus = []
+    for _ in range(size):
+        words = [rng.choice(FILLER) for _ in range(min(60, max(1, round(rng.lognormvariate(math.log(8), 0.7)))))]
+        kind = rng.random()
+        if kind < hit_rate:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keys))
+        elif kind < hit_rate + math_rate:
+            question = f"what is {rng.randint(0, 999)} {rng.choice(OPERATORS)} {rng.randint(1, 999)}"
+            words.insert(rng.randrange(len(words) + 1), question)
+        corpus.append(" ".join(words))
+    return corpus
+
+
+def scaled_table(table, scale, rng):
+    """`table` plus enough synthetic intents to make it `scale` times larger."""
+    prompts = dict(table.prompts)
+    default = prompts.pop("default", None)
+    for index in range((scale - 1) * len(table.intents)):
+        # Half share their first word with ordinary messages, like real intents do
+        head = rng.choice(FILLER) if index % 2 else f"topic{index}"
+        prompts[f"{head} {rng.choice(FILLER)}{index}"] = f"Synthetic reply {index}"
+    if default is not None:
+        prompts["default"] = default
+    return IntentTable(table.greetings, table.goodbyes, prompts)
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmark the reply handlers over a generated corpus, with the "
+        "intent tables scaled up by each of --scales. Caches are cleared before "
+        "every repetition so each run pays for matching. Write the results with "
+        "--output and compare a later run against them with --baseline."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scales", type=int, nargs="+", default=[1, 10, 100, 1000])
+        parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS)
+        parser.add_argument("--corpus", type=int, default=2000, help="Messages in the corpus")
+        parser.add_argument("--hit-rate", type=float, default=0.4, help="Share of messages naming an intent")
+        parser.add_argument("--math-rate", type=float, default=0.2, help="Share of messages asking a sum")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed runs per target, the median is kept")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--baseline", help="Compare with the results in this JSON file")
+        parser.add_argument(
+            "--tolerance", type=float, default=0.1,
+            help="Slowdown over the baseline counted as a regression (0.1 is 10%%)",
+        )
+
+    def handle(self, *args, **options):
+        from victorAiApp.serializers import generate_ai_reply
+        from victorAiApp.services import turns
+
+        if min(options["scales"]) < 1:
+            raise CommandError("Scales must be 1 or more")
+        rng = random.Random(options["seed"])
+        base = intents.current()
+        corpus = build_corpus(base, options["corpus"], options["hit_rate"], options["math_rate"], rng)
+        math_corpus = [message for message in corpus if MathHandler._extract_expression(message)]
+
+        # Replies come from this process unless the pool runs in other processes,
+        # which only ever see the intents file
+        in_process = turns.pool.mode != "process"
+        functions = {
+            "ResponseHandler.process": (ResponseHandler.process, corpus),
+            "MathHandler.process": (MathHandler.process, math_corpus),
+            "MathHandler._normalize": (MathHandler._normalize, corpus),
+            "generate_ai_reply": (generate_ai_reply, corpus),
+        }
+
+        results = []
+        try:
+            for scale in options["scales"]:
+                # Seeded per scale so a table is the same whichever other scales run
+                table = base if scale == 1 else scaled_table(base, scale, random.Random(f"{options['seed']}-{scale}"))
+                intents.table = table
+                for target in options["targets"]:
+                    if target == "generate_ai_reply" and scale != 1 and not in_process:
+                        continue
+                    function, messages = functions[target]
+                    results.append(self.measure(target, scale, table, function, messages, options["repeat"]))
+        finally:
+            intents.table = base
+
+        report = {
+            "python": platform.python_version(),
+            "executor": turns.pool.mode,
+            "corpus": len(corpus),
+            "hit_rate": options["hit_rate"],
+            "math_rate": options["math_rate"],
+            "seed": options["seed"],
+            "repeat": options["repeat"],
+            "results": results,
+        }
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+
+        baseline = {}
+        if options["baseline"]:
+            try:
+                with open(options["baseline"], encoding="utf-8") as f:
+                    baseline = {(r["target"], r["scale"]): r for r in json.load(f)["results"]}
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f"Invalid baseline file: {e}")
+
+        self.stdout.write(f"{'target':<26}{'scale':>6}{'intents':>9}{'calls':>7}{'us/call':>10}{'best':>9}{'change':>9}")
+        regressions = []
+        for result in results:
+            line = (
+                f"{result['target']:<26}{result['scale']:>6}{result['intents']:>9}{result['calls']:>7}"
+                f"{result['us_per_call']:>10.2f}{result['best_us_per_call']:>9.2f}"
+            )
+            previous = baseline.get((result["target"], result["scale"]))
+            if previous:
+                change = result["us_per_call"] / previous["us_per_call"] - 1
+                line += f"{change:>+9.1%}"
+                if change > options["tolerance"]:
+                    regressions.append(f"{result['target']} x{result['scale']} {change:+.1%}")
+            self.stdout.write(line)
+
+        if regressions:
+            raise CommandError("Slower than the baseline: " + ", ".join(regressions))
+
+    def measure(self, target, scale, table, function, messages, repeat):
+        timings = []
+        for _ in range(repeat):
+            table.cache.cache_clear()
+            Calculator._evaluate.cache_clear()
+            started = time.perf_counter()
+            for message in messages:
+                function(message)
+            timings.append((time.perf_counter() - started) / max(1, len(messages)) * 1e6)
+        return {
+            "target": target,
+            "scale": scale,
+            "intents": len(table.intents),
+            "calls": len(messages),
+            "us_per_call": statistics.median(timings),
+            "best_us_per_call": min(timings),
+        }
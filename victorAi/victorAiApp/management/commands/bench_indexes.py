@@ -0,0 +1,129 @@
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+# Last migration before the conversation indexes were added
+BEFORE_INDEXES = "0006_memorymessage"
+
+
+# AiMemory columns that exist before and after the migrations, fields added
+# since (like the conversation summary) aren't in the "before" schema
+MEMORY_COLUMNS = ("id", "user", "title", "revision", "message_count", "created_at", "updated_at")
+
+
+def hot_queries():
+    from victorAiApp.models import AiMemory, UserChat
+
+    memories = AiMemory.objects.only(*MEMORY_COLUMNS)
+    return [
+        ("anonymous conversations", lambda user: memories.filter(user=None).order_by("-updated_at")[:5]),
+        ("latest conversation", lambda user: memories.filter(user=user).order_by("-id")[:1]),
+        ("conversation page", lambda user: memories.filter(user=user).order_by("-updated_at", "-id")[:20]),
+        ("recent chats", lambda user: UserChat.objects.filter(user=user).order_by("-created_at")[:20]),
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the query plans and timings of the hot conversation queries before "
+        "and after the conversation index migrations, on a throwaway SQLite "
+        "database filled with --rows conversations and chats."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="Rows in each of AiMemory and UserChat")
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--anonymous", type=float, default=0.1, help="Share of rows without a user")
+        parser.add_argument("--repeat", type=int, default=100, help="Runs of each query to time")
+        parser.add_argument("--worker", action="store_true", help="Internal: run against the configured database")
+
+    def handle(self, *args, **options):
+        if options["worker"]:
+            return self.run_worker(options)
+
+        with tempfile.TemporaryDirectory() as directory:
+            env = {
+                **os.environ,
+                "DATABASE_ENGINE": "sqlite",
+                "SQLITE_PATH": os.path.join(directory, "bench.sqlite3"),
+            }
+            command = [sys.executable, sys.argv[0], "bench_indexes", "--worker"]
+            for name in ("rows", "users", "anonymous", "repeat"):
+                command += [f"--{name}", str(options[name])]
+            subprocess.run(command, env=env).check_returncode()
+
+    def run_worker(self, options):
+        call_command("migrate", "victorAiApp", BEFORE_INDEXES, verbosity=0)
+
+        started = time.perf_counter()
+        user = self.fill(options["rows"], options["users"], options["anonymous"])
+        self.stdout.write(f"Inserted {options['rows']} conversations and chats in {time.perf_counter() - started:.1f}s\n")
+
+        self.report("Before", user, options["repeat"])
+
+        started = time.perf_counter()
+        call_command("migrate", verbosity=0)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+        self.stdout.write(f"\nMigrated and analyzed in {time.perf_counter() - started:.1f}s\n")
+
+        self.report("After", user, options["repeat"])
+
+    def fill(self, rows, users, anonymous, batch=20_000):
+        """Insert the rows with raw SQL, returning the id of a user to query for."""
+        from victorAiApp.models import AiMemory, CustomUser, UserChat
+
+        rng = random.Random(0)
+        CustomUser.objects.bulk_create(
+            CustomUser(username=f"bench{index}", email=f"bench{index}@example.com") for index in range(users)
+        )
+        user_ids = list(CustomUser.objects.values_list("id", flat=True))
+        start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+        def owner():
+            return None if rng.random() < anonymous else rng.choice(user_ids)
+
+        def stamp():
+            return (start + timedelta(seconds=rng.randrange(365 * 86400))).isoformat()
+
+        memory = AiMemory._meta.db_table
+        chat = UserChat._meta.db_table
+        with connection.cursor() as cursor:
+            for offset in range(0, rows, batch):
+                count = min(batch, rows - offset)
+                cursor.executemany(
+                    f"INSERT INTO {memory} (created_at, updated_at, session_id, user_id, title, revision, message_count)"
+                    " VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                    [(stamp(), stamp(), uuid.uuid4().hex, owner(), "benchmark", 2, 1) for _ in range(count)],
+                )
+                cursor.executemany(
+                    f"INSERT INTO {chat} (created_at, updated_at, user_id, message) VALUES (%s, %s, %s, %s)",
+                    [(stamp(), stamp(), owner(), "benchmark message") for _ in range(count)],
+                )
+        return user_ids[len(user_ids) // 2]
+
+    def report(self, label, user, repeat):
+        self.stdout.write(f"\n{label} the indexes:")
+        for name, query in hot_queries():
+            queryset = query(user)
+            sql, params = queryset.query.sql_with_params()
+            # Time the database alone, the ORM overhead is the same either way
+            with connection.cursor() as cursor:
+                started = time.perf_counter()
+                for _ in range(repeat):
+                    cursor.execute(sql, params)
+                    cursor.fetchall()
+            elapsed = (time.perf_counter() - started) / repeat * 1000
+
+            # SQLite prefixes each plan line with node ids, keep the description
+            plan = [line.split(" ", 3)[-1] for line in queryset.explain().splitlines()]
+            self.stdout.write(f"  {name:<26}{elapsed:>9.3f} ms   {' / '.join(plan)}")
@@ -0,0 +1,339 @@
+import asyncio
+import json
+import os
+import random
+import secrets
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+
+# Messages sent for each category of the mix
+MESSAGES = {
+    "greeting": ["hello", "hi there", "good morning", "hey, how are you"],
+    "math": ["what is 12 * 7", "what is 3 + 4 * 2", "what is 100 / 8", "what is 2 - 9"],
+    "prompt": ["tell me a joke", "what are you", "what is machine learning", "who built you"],
+    "unknown": ["how tall is mount everest", "recommend a book about gardening", "the quick brown fox"],
+}
+
+# Lifts the CHAT_LIMITS rate limits so they don't cap the measured throughput
+UNLIMITED = {
+    "CHAT_LIMIT_CONNECTION_RATE": "1000000",
+    "CHAT_LIMIT_CONNECTION_BURST": "1000000",
+    "CHAT_LIMIT_USER_RATE": "1000000",
+    "CHAT_LIMIT_USER_BURST": "1000000",
+}
+
+
+class QueryCounter:
+    """Counts the SQL queries run on every database connection opened from now on."""
+
+    def __init__(self):
+        from django.db.backends.signals import connection_created
+
+        self.count = 0
+        self.lock = threading.Lock()
+        connection_created.connect(self.install, weak=False)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+
+class InProcessSocket:
+    """A socket on the ASGI application running in this process."""
+
+    def __init__(self, application, path):
+        from channels.testing import WebsocketCommunicator
+
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=30)
+        if not connected:
+            raise ConnectionError("WebSocket rejected")
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def recv(self):
+        message = await self.communicator.receive_output(timeout=None)
+        if message["type"] != "websocket.send":
+            raise ConnectionError(f"WebSocket closed with code {message.get('code')}")
+        return message["text"]
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class NetworkSocket:
+    """A socket on a server listening at `url`."""
+
+    def __init__(self, url):
+        self.url = url
+        self.connection = None
+
+    async def connect(self):
+        import websockets
+
+        self.connection = await websockets.connect(self.url, max_size=None, ping_interval=None)
+
+    async def send(self, text):
+        await self.connection.send(text)
+
+    async def recv(self):
+        return await self.connection.recv()
+
+    async def close(self):
+        await self.connection.close()
+
+
+class LoadClient:
+    """One simulated user: sends its messages one after another, timing each reply."""
+
+    def __init__(self, socket, stats):
+        self.socket = socket
+        self.stats = stats
+        self.pending = None
+        self.reader = None
+
+    async def open(self):
+        await self.socket.connect()
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        try:
+            while True:
+                text = await self.socket.recv()
+                kind = json.loads(text).get("type")
+                if kind == "conversation_update":
+                    self.stats["update_bytes"] += len(text.encode())
+                elif kind in ("chat_response", "chat_response_end", "error"):
+                    if self.pending is not None and not self.pending.done():
+                        self.pending.set_result(kind)
+        except Exception as e:
+            if self.pending is not None and not self.pending.done():
+                self.pending.set_exception(e)
+
+    async def chat(self, messages, stream, think):
+        loop = asyncio.get_running_loop()
+        for message in messages:
+            self.pending = loop.create_future()
+            started = time.perf_counter()
+            await self.socket.send(json.dumps({"type": "chat_message", "message": message, "stream": stream}))
+            if await self.pending == "error":
+                self.stats["errors"] += 1
+            else:
+                self.stats["latencies"].append(time.perf_counter() - started)
+            if think:
+                await asyncio.sleep(random.expovariate(1 / think))
+
+    async def close(self):
+        self.reader.cancel()
+        await self.socket.close()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the ws/chat/ endpoint with concurrent simulated clients, either "
+        "through the ASGI application in a child process or against a spawned "
+        "Daphne server. Each active client sends --messages chat messages drawn "
+        "from --mix and waits for every reply; --idle of the clients only listen. "
+        "Reports messages per second, reply latency percentiles, conversation_update "
+        "bytes per second and database queries. Runs on a throwaway SQLite database."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--target", choices=["inprocess", "daphne"], default="inprocess")
+        parser.add_argument("--clients", type=int, default=50, help="Concurrent WebSocket clients")
+        parser.add_argument("--messages", type=int, default=20, help="Messages sent by each active client")
+        parser.add_argument(
+            "--mix", nargs="+", default=["greeting=2", "math=1", "prompt=1", "unknown=1"],
+            help=f"Message categories with weights, from {', '.join(MESSAGES)}",
+        )
+        parser.add_argument("--idle", type=float, default=0.2, help="Fraction of clients that never send")
+        parser.add_argument("--think", type=float, default=0.0, help="Mean seconds between a client's messages")
+        parser.add_argument(
+            "--users", type=int, default=None,
+            help="Clients are spread over this many users (default one per client, 0 for anonymous)",
+        )
+        parser.add_argument("--stream", action="store_true", help="Ask for streamed replies")
+        parser.add_argument("--limits", action="store_true", help="Keep the CHAT_LIMITS rate limits")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+        parser.add_argument("--child", action="store_true", help="Internal: run the in-process test")
+        parser.add_argument("--serve", type=int, help="Internal: run Daphne on this port")
+
+    def handle(self, *args, **options):
+        if options["users"] is None:
+            options["users"] = options["clients"]
+        for item in options["mix"]:
+            category, _, weight = item.partition("=")
+            if category not in MESSAGES or not weight.replace(".", "", 1).isdigit():
+                raise CommandError(f"Bad --mix entry {item!r}, expected <category>=<weight>")
+        if options["serve"]:
+            return self.serve(options)
+        if options["child"]:
+            return self.run_child(options)
+
+        with tempfile.TemporaryDirectory() as directory:
+            env = {**os.environ, "SQLITE_PATH": os.path.join(directory, "bench.sqlite3")}
+            # Tokens are signed with SECRET_KEY, which may only be set in production
+            env.setdefault("SECRET_KEY", secrets.token_hex(32))
+            if not options["limits"]:
+                env.update(UNLIMITED)
+            subprocess.run(
+                [sys.executable, sys.argv[0], "migrate", "--skip-checks", "--verbosity", "0"], env=env
+            ).check_returncode()
+
+            if options["target"] == "inprocess":
+                subprocess.run([sys.executable, sys.argv[0], *sys.argv[1:], "--child"], env=env).check_returncode()
+            else:
+                self.run_daphne(options, env)
+
+    def create_users(self, count):
+        """Create `count` users and return an access token for each."""
+        from rest_framework_simplejwt.tokens import AccessToken
+        from victorAiApp.models import CustomUser
+
+        users = CustomUser.objects.bulk_create(
+            CustomUser(username=f"load{index}", email=f"load{index}@example.com") for index in range(count)
+        )
+        return [str(AccessToken.for_user(user)) for user in users]
+
+    def run_child(self, options):
+        from victorAi.asgi import application
+
+        tokens = self.create_users(options["users"])
+        counter = QueryCounter()
+
+        def connect(token):
+            return InProcessSocket(application, "/ws/chat/" + (f"?token={token}" if token else ""))
+
+        results = asyncio.run(self.drive(connect, tokens, options))
+        results["queries"] = counter.count
+        self.report(results, options)
+
+    def run_daphne(self, options, env):
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+
+        server = subprocess.Popen(
+            [sys.executable, sys.argv[0], "bench_ws", "--serve", str(port), "--users", str(options["users"])],
+            env=env, stdout=subprocess.PIPE, text=True,
+        )
+        try:
+            # The server prints "ready <tokens>" once it is listening
+            line = server.stdout.readline()
+            if not line.startswith("ready "):
+                raise RuntimeError("Daphne did not start")
+            tokens = json.loads(line[len("ready "):])
+
+            def connect(token):
+                return NetworkSocket(f"ws://127.0.0.1:{port}/ws/chat/" + (f"?token={token}" if token else ""))
+
+            results = asyncio.run(self.drive(connect, tokens, options))
+        finally:
+            server.send_signal(signal.SIGINT)
+            output = server.communicate(timeout=30)[0]
+
+        # ...and "queries <count>" when it stops
+        results["queries"] = int(output.split("queries ")[-1].split()[0]) if "queries " in output else None
+        self.report(results, options)
+
+    def serve(self, options):
+        from daphne.endpoints import build_endpoint_description_strings
+        from daphne.server import Server
+        from victorAi.asgi import application
+
+        tokens = self.create_users(options["users"])
+        counter = QueryCounter()
+
+        def ready():
+            print(f"ready {json.dumps(tokens)}", flush=True)
+
+        Server(
+            application=application,
+            endpoints=build_endpoint_description_strings(host="127.0.0.1", port=options["serve"]),
+            ready_callable=ready,
+            verbosity=0,
+        ).run()
+        print(f"queries {counter.count}", flush=True)
+
+    async def drive(self, connect, tokens, options):
+        rng = random.Random(options["seed"])
+        weights = dict(item.split("=") for item in options["mix"])
+        categories = list(weights)
+        active = options["clients"] - round(options["clients"] * options["idle"])
+
+        stats = {"latencies": [], "errors": 0, "update_bytes": 0}
+        clients = [
+            LoadClient(connect(tokens[index % len(tokens)] if tokens else None), stats)
+            for index in range(options["clients"])
+        ]
+        await asyncio.gather(*(client.open() for client in clients))
+        stats["update_bytes"] = 0
+
+        scripts = [
+            [
+                rng.choice(MESSAGES[category])
+                for category in rng.choices(categories, [float(weights[c]) for c in categories], k=options["messages"])
+            ]
+            for _ in range(active)
+        ]
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            client.chat(script, options["stream"], options["think"]) for client, script in zip(clients, scripts)
+        ))
+        elapsed = time.perf_counter() - started
+        # Let the last updates reach the listeners
+        await asyncio.sleep(0.2)
+        await asyncio.gather(*(client.close() for client in clients))
+
+        latencies = sorted(stats["latencies"])
+        return {
+            "target": options["target"],
+            "clients": options["clients"],
+            "active": active,
+            "messages": len(latencies),
+            "errors": stats["errors"],
+            "seconds": elapsed,
+            "messages_per_second": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "update_bytes_per_second": stats["update_bytes"] / elapsed,
+        }
+
+    def report(self, results, options):
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+            return
+        queries = results["queries"]
+        per_message = f"{queries / results['messages']:.1f}" if queries is not None and results["messages"] else "-"
+        self.stdout.write(
+            f"{'target':<10}{'clients':>8}{'msgs':>7}{'errors':>7}{'msg/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+            f"{'p99 ms':>9}{'update B/s':>12}{'queries':>9}{'q/msg':>7}"
+        )
+        self.stdout.write(
+            f"{results['target']:<10}{results['clients']:>8}{results['messages']:>7}{results['errors']:>7}"
+            f"{results['messages_per_second']:>9.1f}{results['p50_ms']:>9.1f}{results['p95_ms']:>9.1f}"
+            f"{results['p99_ms']:>9.1f}{results['update_bytes_per_second']:>12.0f}{queries if queries is not None else '-':>9}"
+            f"{per_message:>7}"
+        )
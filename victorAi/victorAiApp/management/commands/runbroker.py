@@ -0,0 +1,28 @@
+import asyncio
+from django.core.management.base import BaseCommand
+from victorAiApp.broker import PubSubBroker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the local pub/sub broker so several Daphne workers can share groups "
+        "without Redis. Point them at it with CHANNEL_LAYER=redis-pubsub and "
+        "REDIS_URL=redis://HOST:PORT."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=6379)
+
+    def handle(self, *args, **options):
+        async def serve():
+            server = await PubSubBroker().start(options["host"], options["port"])
+            self.stdout.write(f"Broker listening on redis://{options['host']}:{options['port']}")
+            async with server:
+                await server.serve_forever()
+
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,48 @@
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.core.management.base import BaseCommand
+from victorAiApp.handlers import ResponseHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a fake model server for the http generator backend. It answers "
+        "POST {\"messages\": [...]} with the rule engine's replies after --delay "
+        "seconds per request, however many messages it holds, like a model "
+        "decoding a batch. Use it with CHAT_GENERATOR_BACKEND=http."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8081)
+        parser.add_argument("--delay", type=float, default=0.05, help="Seconds spent on each request")
+
+    def handle(self, *args, **options):
+        delay = options["delay"]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    messages = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["messages"]
+                except (TypeError, ValueError, KeyError):
+                    self.send_error(400, "Expected {\"messages\": [...]}")
+                    return
+                time.sleep(delay)
+                body = json.dumps({"replies": [ResponseHandler.process(message) for message in messages]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((options["host"], options["port"]), Handler)
+        self.stdout.write(f"Model server listening on http://{options['host']}:{options['port']}/generate")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,307 @@
+# metrics.py
+import atexit
+import bisect
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# The directory where the server and its generation workers write their
+# metrics for /metrics to add up. Give every deployment its own, shared by all
+# its server processes; unset, a server makes a private one for itself and
+# its workers.
+METRICS_DIR = os.getenv("CHAT_METRICS_DIR", "")
+METRICS_FLUSH_INTERVAL = float(os.getenv("CHAT_METRICS_FLUSH_INTERVAL", "5"))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    """A count per combination of label values, e.g. counter.labels(intent="math").inc()."""
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.children = {}
+
+    def labels(self, **labels):
+        """The count for these label values. Keep it around on hot paths."""
+        key = tuple(str(labels.get(label, "")) for label in self.label_names)
+        return self.children.setdefault(key, CounterChild())
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def reset(self):
+        for child in self.children.values():
+            child.reset()
+
+    def sample(self):
+        return [[dict(zip(self.label_names, key)), child.value] for key, child in list(self.children.items())]
+
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        # counts[i] observations fell in bucket i, the last one is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def sample(self):
+        with self.lock:
+            return [[{}, {"buckets": self.buckets, "counts": list(self.counts), "sum": self.sum}]]
+
+
+class Gauge:
+    """A value read from `function` whenever metrics are collected."""
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def reset(self):
+        pass
+
+    def sample(self):
+        try:
+            return [[{}, self.function()]]
+        except Exception:
+            return []
+
+
+class CounterFunction(Gauge):
+    """A counter read from `function`, for counts kept elsewhere, e.g. by a cache."""
+
+
+class Registry:
+    """
+    The metrics of this process.
+
+    Updates only take the lock of the metric being updated, for a couple of
+    additions. Once start() is called, a background thread writes a snapshot
+    of every metric to `directory` every `flush_interval` seconds, and
+    render() adds up the snapshots of all processes: counters and histograms
+    of every process of this deployment, including ones that have exited
+    (e.g. a generation worker restarted after a timeout), gauges only of live
+    processes. Snapshots older than every live process are from an earlier
+    run and are deleted. Processes that never call start(), like management
+    commands, keep their metrics to themselves.
+    """
+
+    TYPES = {Counter: "counter", Histogram: "histogram", Gauge: "gauge", CounterFunction: "counter"}
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.path = None
+        self.flusher = None
+        self.written = None
+        os.register_at_fork(after_in_child=self.forked)
+
+    def counter(self, name, help, labels=()):
+        return self.metrics.setdefault(name, Counter(name, help, labels))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def gauge(self, name, help, function):
+        self.metrics[name] = Gauge(name, help, function)
+        return self.metrics[name]
+
+    def counter_function(self, name, help, function):
+        self.metrics[name] = CounterFunction(name, help, function)
+        return self.metrics[name]
+
+    def start(self, private=False):
+        """
+        Share this process's metrics through the directory. With `private`
+        and no directory configured, as in a server, make one and hand it to
+        the processes started from here on through CHAT_METRICS_DIR.
+        """
+        with self.lock:
+            if self.flusher is not None:
+                return
+            if not self.directory:
+                if not private:
+                    return
+                self.directory = tempfile.mkdtemp(prefix="victorai-metrics-")
+                os.environ["CHAT_METRICS_DIR"] = self.directory
+                atexit.register(shutil.rmtree, self.directory, True)
+            self.path = os.path.join(self.directory, f"{os.getpid()}-{int(self.started * 1e6)}.json")
+            self.flusher = threading.Thread(target=self.flush_forever, name="metrics", daemon=True)
+            self.flusher.start()
+        atexit.register(self.flush)
+
+    def forked(self):
+        # A forked child counts from zero and keeps it to itself until it starts
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.path = self.flusher = self.written = None
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def flush_forever(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def snapshot(self):
+        return {
+            "pid": os.getpid(),
+            "started": self.started,
+            "updated": time.time(),
+            "metrics": {
+                name: {"type": self.TYPES[type(metric)], "help": metric.help, "samples": metric.sample()}
+                for name, metric in self.metrics.items()
+            },
+        }
+
+    def flush(self):
+        snapshot = self.snapshot()
+        body = json.dumps(snapshot["metrics"])
+        if body == self.written:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(self.path + ".tmp", self.path)
+            self.written = body
+        except OSError as e:
+            print(f"Metrics flush error: {e}")
+
+    def collect(self):
+        """Snapshots of this process and the others to add up, as (snapshot, alive) pairs."""
+        own = self.snapshot()
+        if not self.directory or not os.path.isdir(self.directory):
+            return [(own, True)]
+
+        others = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json") or entry.path == self.path:
+                continue
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    others.append((entry.path, json.load(f)))
+            except (OSError, ValueError):
+                continue
+
+        snapshots = [(own, True)]
+        alive = [(snapshot, process_alive(snapshot["pid"])) for _, snapshot in others]
+        oldest = min([own["started"]] + [snapshot["started"] for snapshot, live in alive if live])
+        for (path, snapshot), (_, live) in zip(others, alive):
+            if live or snapshot["updated"] >= oldest:
+                snapshots.append((snapshot, live))
+            else:
+                with contextlib.suppress(OSError):
+                    os.remove(path)
+        return snapshots
+
+    def render(self):
+        """All processes' metrics in the Prometheus text format."""
+        merged = {}
+        for snapshot, live in self.collect():
+            for name, metric in snapshot["metrics"].items():
+                if metric["type"] == "gauge" and not live:
+                    continue
+                entry = merged.setdefault(name, {"type": metric["type"], "help": metric["help"], "samples": {}})
+                for labels, value in metric["samples"]:
+                    key = tuple(sorted(labels.items()))
+                    if metric["type"] != "histogram":
+                        entry["samples"][key] = entry["samples"].get(key, 0) + value
+                        continue
+                    total = entry["samples"].setdefault(
+                        key, {"buckets": value["buckets"], "counts": [0] * len(value["counts"]), "sum": 0.0}
+                    )
+                    if total["buckets"] == value["buckets"]:
+                        total["counts"] = [a + b for a, b in zip(total["counts"], value["counts"])]
+                        total["sum"] += value["sum"]
+
+        lines = []
+        for name, entry in sorted(merged.items()):
+            lines.append(f"# HELP {name} {entry['help']}")
+            lines.append(f"# TYPE {name} {entry['type']}")
+            for key, value in sorted(entry["samples"].items()):
+                if entry["type"] != "histogram":
+                    lines.append(f"{name}{format_labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(value["buckets"] + ["+Inf"], value["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(key)} {value['sum']}")
+                lines.append(f"{name}_count{format_labels(key)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(items):
+    if not items:
+        return ""
+    return "{" + ",".join(f'{label}="{value}"' for label, value in items) + "}"
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+generation_seconds = registry.histogram("chat_generation_seconds", "Time to generate a reply")
+db_save_seconds = registry.histogram("chat_db_save_seconds", "Time to store a batch of chat turns")
+write_behind_failed = registry.counter("chat_write_behind_failed_total", "Queued turns that could not be stored")
+update_serialize_seconds = registry.histogram(
+    "chat_update_serialize_seconds", "Time to serialize a conversation_update frame"
+)
+messages_total = registry.counter(
+    "chat_messages_total", "Messages answered by the rule engine, by matched intent category", ["intent"]
+)
@@ -0,0 +1,49 @@
+# middleware.py
+from urllib.parse import parse_qs
+from django.contrib.auth.models import AnonymousUser
+from channels.auth import AuthMiddlewareStack
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates WebSocket handshakes with the same simplejwt access tokens
+    as the REST API.
+
+    Browsers can't set headers on a WebSocket, so the token is read from the
+    `token` query parameter, falling back to an Authorization header. When no
+    token is sent the user from the session is kept; a bad token leaves an
+    anonymous user and sets scope["auth_error"] so the consumer can refuse it.
+    """
+
+    authentication = JWTAuthentication()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            raw_token = self.get_raw_token(scope)
+            if raw_token is not None:
+                scope = dict(scope, user=await self.get_user(raw_token))
+        except (InvalidToken, AuthenticationFailed):
+            scope = dict(scope, user=AnonymousUser(), auth_error="Invalid or expired token")
+        return await super().__call__(scope, receive, send)
+
+    def get_raw_token(self, scope):
+        query = parse_qs(scope.get("query_string", b"").decode())
+        if query.get("token"):
+            return query["token"][0].encode()
+        for name, value in scope.get("headers", []):
+            if name == b"authorization":
+                return self.authentication.get_raw_token(value)
+        return None
+
+    @database_sync_to_async
+    def get_user(self, raw_token):
+        validated_token = self.authentication.get_validated_token(raw_token)
+        return self.authentication.get_user(validated_token)
+
+
+def JWTAuthMiddlewareStack(inner):
+    return AuthMiddlewareStack(JWTAuthMiddleware(inner))
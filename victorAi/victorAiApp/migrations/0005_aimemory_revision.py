@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("victorAiApp", "0004_aimemory_title"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="aimemory",
+            name="revision",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
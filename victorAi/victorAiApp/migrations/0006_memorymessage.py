@@ -0,0 +1,62 @@
+# Generated by Django 5.2.6 on 2026-10-18 17:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def split_messages(apps, schema_editor):
+    """Move every AiMemory.messages blob into MemoryMessage rows."""
+    AiMemory = apps.get_model('victorAiApp', 'AiMemory')
+    MemoryMessage = apps.get_model('victorAiApp', 'MemoryMessage')
+    for memory in AiMemory.objects.iterator():
+        messages = memory.messages or []
+        MemoryMessage.objects.bulk_create(
+            MemoryMessage(memory=memory, sequence=sequence, content=content)
+            for sequence, content in enumerate(messages)
+        )
+        AiMemory.objects.filter(pk=memory.pk).update(message_count=len(messages))
+
+
+def join_messages(apps, schema_editor):
+    """Rebuild the AiMemory.messages blobs from MemoryMessage rows."""
+    AiMemory = apps.get_model('victorAiApp', 'AiMemory')
+    MemoryMessage = apps.get_model('victorAiApp', 'MemoryMessage')
+    for memory in AiMemory.objects.iterator():
+        messages = list(
+            MemoryMessage.objects.filter(memory=memory).order_by('sequence').values_list('content', flat=True)
+        )
+        AiMemory.objects.filter(pk=memory.pk).update(messages=messages)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('victorAiApp', '0005_aimemory_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimemory',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MemoryMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sequence', models.PositiveIntegerField()),
+                ('content', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('memory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='victorAiApp.aimemory')),
+            ],
+            options={
+                'ordering': ['sequence'],
+                'constraints': [models.UniqueConstraint(fields=('memory', 'sequence'), name='unique_memory_message_sequence')],
+            },
+        ),
+        migrations.RunPython(split_messages, join_messages),
+        migrations.RemoveField(
+            model_name='aimemory',
+            name='messages',
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('victorAiApp', '0006_memorymessage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aimemory',
+            index=models.Index(fields=['user', 'updated_at', 'id'], name='aimemory_user_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('victorAiApp', '0007_aimemory_user_updated_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aimemory',
+            index=models.Index(fields=['user', 'id'], name='aimemory_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aimemory',
+            index=models.Index(condition=models.Q(('user__isnull', True)), fields=['updated_at'], name='aimemory_anon_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userchat',
+            index=models.Index(fields=['user', 'created_at'], name='userchat_user_created_idx'),
+        ),
+    ]
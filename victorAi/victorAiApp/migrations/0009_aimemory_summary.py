@@ -0,0 +1,23 @@
+# Generated by Django 5.2.6 on 2026-10-18 18:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('victorAiApp', '0008_conversation_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aimemory',
+            name='summary',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='aimemory',
+            name='summary_upto',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
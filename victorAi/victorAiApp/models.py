@@ -68,6 +68,11 @@ class VictorAi(TimeStampField):
 class UserChat(TimeStampField):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='chats', null=True)
     message = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_at"], name="userchat_user_created_idx"),
+        ]
     
     def __str__(self):
         return f"{self.user}: {self.message[:30]}"
@@ -75,29 +80,44 @@ class UserChat(TimeStampField):
 class AiMemory(TimeStampField):
     session_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     user = models.ForeignKey("CustomUser", on_delete=models.CASCADE, related_name="ai_conversations", null=True)
-    messages = models.JSONField(default=list)
     title = models.TextField(blank=True)
+    revision = models.PositiveIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    # Messages before sequence `summary_upto` are folded into `summary`
+    summary = models.TextField(blank=True)
+    summary_upto = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Keyset pages of a user's conversations, most recently updated first
+            models.Index(fields=["user", "updated_at", "id"], name="aimemory_user_updated_idx"),
+            # Latest conversation of a user, appended to on every turn
+            models.Index(fields=["user", "id"], name="aimemory_user_id_idx"),
+            # The shared anonymous stream, kept small by leaving user rows out
+            models.Index(
+                fields=["updated_at"], condition=models.Q(user__isnull=True), name="aimemory_anon_updated_idx"
+            ),
+        ]
     
     def __str__(self):
         return f"Conversation history for {self.user}"
-    
-    def log_user_message(self, user_chat: UserChat):
-        self.messages.append({
-            "role": "user",
-            "content": user_chat.message,
-            "timestamp": user_chat.created_at.isoformat(),
-        })
-        self.save()
-    
-    def log_ai_reply(self, ai_message: VictorAi):
-        self.messages.append({
-            "role": "Assistant",
-            "content": ai_message.response,
-            "timestamp": ai_message.created_at.isoformat(),
-        })
-        self.save()
-        
+
     def get_conversation(self):
-        return self.messages
-    
-    
\ No newline at end of file
+        return [entry.content for entry in self.entries.all()]
+
+
+class MemoryMessage(models.Model):
+    """One message of an AiMemory conversation, appended in sequence order."""
+    memory = models.ForeignKey(AiMemory, on_delete=models.CASCADE, related_name="entries")
+    sequence = models.PositiveIntegerField()
+    content = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["sequence"]
+        constraints = [
+            models.UniqueConstraint(fields=["memory", "sequence"], name="unique_memory_message_sequence"),
+        ]
+
+    def __str__(self):
+        return f"Message {self.sequence} of {self.memory_id}"
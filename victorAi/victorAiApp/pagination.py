@@ -0,0 +1,101 @@
+# pagination.py
+import base64
+import json
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages through a queryset by the values of its last row instead of an
+    offset, so every page costs one index range scan however deep it is.
+
+    `ordering` must end in a unique field. The cursor is an opaque token
+    holding the ordering values of the last row served; rows inserted or
+    updated meanwhile never shift the pages that follow.
+    """
+    ordering = ("-updated_at", "-id")
+    page_size = 20
+    max_page_size = 100
+    cursor_query_param = "cursor"
+    page_size_query_param = "limit"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        position = self.decode_cursor(request)
+        try:
+            if position is not None:
+                queryset = queryset.filter(self.after(position))
+            rows = list(queryset.order_by(*self.ordering)[:self.limit + 1])
+        except (ValidationError, ValueError, TypeError):
+            raise NotFound("Invalid cursor")
+        self.page = rows[:self.limit]
+        self.has_next = len(rows) > self.limit
+        return self.page
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(limit, self.max_page_size))
+
+    def after(self, position):
+        """Rows that come after `position` in ordering, as one Q for the index."""
+        condition = Q()
+        for index in reversed(range(len(self.ordering))):
+            field = self.ordering[index].lstrip("-")
+            lookup = "lt" if self.ordering[index].startswith("-") else "gt"
+            step = Q(**{f"{field}__{lookup}": position[index]})
+            if index < len(self.ordering) - 1:
+                step |= Q(**{field: position[index]}) & condition
+            condition = step
+        # The redundant bound on the leading field lets the database seek
+        # straight to the position instead of filtering from the first row
+        field = self.ordering[0].lstrip("-")
+        lookup = "lte" if self.ordering[0].startswith("-") else "gte"
+        return Q(**{f"{field}__{lookup}": position[0]}) & condition
+
+    def position(self, row):
+        values = []
+        for field in self.ordering:
+            value = getattr(row, field.lstrip("-"))
+            values.append(value.isoformat() if hasattr(value, "isoformat") else value)
+        return values
+
+    def encode_cursor(self, row):
+        data = json.dumps(self.position(row), separators=(",", ":")).encode()
+        return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+    def decode_cursor(self, request):
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        try:
+            position = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        except ValueError:
+            raise NotFound("Invalid cursor")
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound("Invalid cursor")
+        return position
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
+
+
+class MessagePagination(KeysetPagination):
+    """Messages of one conversation, oldest first."""
+    ordering = ("sequence",)
+    page_size = 50
+    max_page_size = 200
@@ -0,0 +1,211 @@
+# persistence.py
+import atexit
+import asyncio
+from typing import NamedTuple
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from .metrics import db_save_seconds, write_behind_failed
+from .models import UserChat, VictorAi, AiMemory, MemoryMessage
+
+
+class Turn(NamedTuple):
+    """One user message and the AI reply to it, waiting to be stored."""
+    user: object
+    message: str
+    response: str
+    title: str
+
+
+@db_save_seconds.time()
+def persist_turns(turns, max_messages):
+    """
+    Store a batch of turns in one transaction and return a change per turn.
+
+    Each turn is appended to its user's latest conversation, starting a new
+    one once it holds max_messages (never if that is None). Whatever the batch size this costs one
+    INSERT per table, one locked SELECT per user and one UPDATE per existing
+    conversation that was appended to.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        # SQLite holds the write lock from BEGIN (IMMEDIATE) or the first
+        # INSERT, other backends lock the conversation rows below.
+        chats = UserChat.objects.bulk_create(
+            UserChat(user=turn.user, message=turn.message) for turn in turns
+        )
+        VictorAi.objects.bulk_create(
+            VictorAi(user_chat=chat, response=turn.response) for chat, turn in zip(chats, turns)
+        )
+
+        current = {}
+        appended = []
+        touched = []
+        for turn in turns:
+            key = turn.user.pk if turn.user else None
+            if key in current:
+                memory = current[key]
+            else:
+                memory = AiMemory.objects.select_for_update().filter(user=turn.user).order_by("-id").first()
+
+            if memory is None or (max_messages and memory.message_count >= max_messages):
+                memory = AiMemory(user=turn.user, title=turn.title)
+
+            if current.get(key) is not memory:
+                touched.append(memory)
+            current[key] = memory
+            appended.append((memory, memory.message_count, turn))
+            memory.message_count += 1
+            memory.revision += 1
+            memory.updated_at = now
+
+        # New conversations are inserted with their final counters
+        existing = [memory for memory in touched if memory.pk is not None]
+        AiMemory.objects.bulk_create(memory for memory in touched if memory.pk is None)
+        for memory in existing:
+            AiMemory.objects.filter(pk=memory.pk).update(
+                message_count=memory.message_count,
+                revision=memory.revision,
+                updated_at=now,
+            )
+
+        MemoryMessage.objects.bulk_create(
+            MemoryMessage(memory=memory, sequence=sequence, content={"user": turn.message, "ai": turn.response})
+            for memory, sequence, turn in appended
+        )
+
+    return [
+        {
+            "id": str(memory.id),
+            "user": memory.user_id,
+            "revision": memory.revision - memory.message_count + sequence + 1,
+            "title": memory.title,
+            "offset": sequence,
+            "messages": [{"user": turn.message, "ai": turn.response}],
+            "updated_at": memory.updated_at.isoformat()
+        }
+        for memory, sequence, turn in appended
+    ]
+
+
+class WriteBehindQueue:
+    """
+    Collects turns in memory and stores them in batches.
+
+    A batch is flushed once it holds `max_batch` turns or `flush_interval`
+    seconds after its first turn arrived. Each flush is handed to
+    `on_flush(changes)` after it commits. If a batch fails, its turns are
+    stored one by one, so one bad turn only loses itself. The server awaits
+    drain() before it shuts down; turns still queued or collected at
+    interpreter exit anyway, e.g. under a server without a shutdown hook, are
+    stored by an atexit hook but not published.
+    """
+
+    def __init__(self, max_messages, on_flush=None, max_batch=50, flush_interval=0.05):
+        self.max_messages = max_messages
+        self.on_flush = on_flush
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.queue = None
+        self.flusher = None
+        # The batch being collected, not yet handed to the database
+        self.batch = []
+        atexit.register(self.drain_sync)
+
+    @classmethod
+    def from_settings(cls, max_messages, on_flush=None):
+        config = getattr(settings, "CHAT_WRITE_BEHIND", {})
+        return cls(
+            max_messages,
+            on_flush=on_flush,
+            max_batch=config.get("MAX_BATCH", 50),
+            flush_interval=config.get("FLUSH_INTERVAL", 0.05),
+        )
+
+    def submit(self, turn: Turn) -> asyncio.Future:
+        """
+        Queue a turn and return a future resolved with its change once stored,
+        or with the exception that kept it from being stored.
+        """
+        loop = asyncio.get_running_loop()
+        if self.flusher is None or self.flusher.done() or self.flusher.get_loop() is not loop:
+            self.queue = asyncio.Queue()
+            self.flusher = loop.create_task(self.run())
+        future = loop.create_future()
+        self.queue.put_nowait((turn, future))
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = self.batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch = []
+            try:
+                await self.flush(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def flush(self, batch):
+        store = database_sync_to_async(persist_turns)
+        try:
+            changes = await store([turn for turn, _ in batch], self.max_messages)
+        except Exception as e:
+            print(f"Write-behind flush error: {e}")
+            if len(batch) == 1:
+                changes = [e]
+            else:
+                # Store them one by one, in order, so only the bad turns are lost
+                changes = []
+                for turn, _ in batch:
+                    try:
+                        changes += await store([turn], self.max_messages)
+                    except Exception as e:
+                        print(f"Write-behind store error: {e}")
+                        changes.append(e)
+
+        for (_, future), change in zip(batch, changes):
+            if isinstance(change, Exception):
+                write_behind_failed.inc()
+                if not future.done():
+                    future.set_exception(change)
+            elif not future.done():
+                future.set_result(change)
+        changes = [change for change in changes if not isinstance(change, Exception)]
+        if changes and self.on_flush:
+            try:
+                await self.on_flush(changes)
+            except Exception as e:
+                print(f"Write-behind publish error: {e}")
+
+    async def drain(self):
+        """Wait until every turn queued so far, including the batch being stored, is stored and published."""
+        if self.queue is None or self.flusher is None or self.flusher.done():
+            return
+        await self.queue.join()
+
+    def drain_sync(self):
+        """Store queued turns without an event loop, used at interpreter exit."""
+        if self.queue is None:
+            return
+        turns = [turn for turn, _ in self.batch]
+        self.batch = []
+        while not self.queue.empty():
+            turns.append(self.queue.get_nowait()[0])
+        if not turns:
+            return
+        try:
+            persist_turns(turns, self.max_messages)
+        except Exception as e:
+            print(f"Write-behind drain error: {e}")
+            write_behind_failed.inc(len(turns))
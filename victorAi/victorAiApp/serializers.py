@@ -1,9 +1,10 @@
 import uuid
 from rest_framework import serializers
-from .models import CustomUser, VictorAi, AiMemory, UserChat
-from .handlers import MathHandler, PROMPTS
+from rest_framework.exceptions import Throttled
+from .models import AiMemory, CustomUser, MemoryMessage, UserChat
+from .generation import PoolSaturated
+from .services import HISTORY_MESSAGES, turns
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-MAX_MESSAGES_PER_CONVERSATION = 20
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -30,21 +31,28 @@ class CustomUserTokenObtainSerializer(TokenObtainPairSerializer):
         return super().validate(attrs)
 
 
+class ConversationListSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = AiMemory
+        fields = ["id", "title", "revision", "message_count", "created_at", "updated_at"]
+
+
+class MemoryMessageSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MemoryMessage
+        fields = ["sequence", "content", "created_at"]
+
+
 def generate_ai_reply(user_message):
-    """Simple AI reply logic based on prompts."""
-    if not user_message:
-        return PROMPTS.get("default")
-    message = user_message.lower()
-    for keyword, reply in PROMPTS.items():
-        if keyword in message:
-            return reply
-    return PROMPTS.get("default")
+    """AI reply for a message, the same one the WebSocket chat gives."""
+    return turns.generate_sync(user_message)
 
 
 class ConversationSerializer(serializers.Serializer):
     """
     Handles a single user->AI message interaction.
     Updates AiMemory with a new title after a threshold of messages.
+    The history holds the last HISTORY_MESSAGES messages of the conversation.
     """
     message = serializers.CharField(write_only=True)
     user_message = serializers.CharField(read_only=True)
@@ -58,40 +66,20 @@ class ConversationSerializer(serializers.Serializer):
         user_message = validated_data['message']
         user = self.context.get('user')  # WebSocket should pass user in context
 
-        # Save user message
-        chat = UserChat.objects.create(user=user, message=user_message)
-
-        # Generate AI reply
-        math_result = MathHandler.process(user_message)
-        if math_result is not None and any(op in user_message for op in "+-*/"):
-            ai_reply = f"The result of {(user_message)} is {math_result}, {generate_ai_reply(user_message)}"
-        else:
-            ai_reply = generate_ai_reply(user_message)
-
-        # Save AI response
-        VictorAi.objects.create(user_chat=chat, response=ai_reply)
-
-        # Update conversation memory
-        latest_memory = AiMemory.objects.filter(user=user).order_by('-id').first()
-
-        if not latest_memory or len(latest_memory.messages) >= MAX_MESSAGES_PER_CONVERSATION:
-            # Start a new conversation memory with a new title
-            memory = AiMemory.objects.create(
-                user=user,
-                title=user_message,
-                messages=[{"user": user_message, "ai": ai_reply}]
-            )
-        else:
-            # Append to existing memory
-            latest_memory.messages.append({"user": user_message, "ai": ai_reply})
-            latest_memory.save()
-            memory = latest_memory
+        # Generate the reply and save the turn, starting a new conversation when full
+        try:
+            ai_reply, change = turns.run_sync(user, user_message)
+        except PoolSaturated:
+            raise Throttled(detail="Server is busy, please try again")
+        history = MemoryMessage.objects.filter(
+            memory_id=change["id"], sequence__gt=change["offset"] - HISTORY_MESSAGES
+        ).values_list("content", flat=True)
 
         return {
             "user_message": user_message,
             "ai_response": ai_reply,
             "conversation_history": [
-                f"{m['user']} | {m['ai']}" for m in memory.messages
+                f"{m['user']} | {m['ai']}" for m in history
             ],
-            "title": memory.title
+            "title": change["title"]
         }
@@ -0,0 +1,274 @@
+# services.py
+import asyncio
+import time
+from typing import NamedTuple
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from .handlers import default_reply
+from .backends import GeneratorBackend, RuleBackend, backend_from_settings
+from .context import ContextBuilder
+from .generation import GenerationPool, PoolSaturated
+from .metrics import generation_seconds, registry
+from .persistence import Turn, WriteBehindQueue, persist_turns
+
+MAX_MESSAGES_PER_CONVERSATION = 20
+# Messages of a conversation sent to clients, the most recent ones
+HISTORY_MESSAGES = getattr(settings, "CHAT_CONTEXT", {}).get("HISTORY_MESSAGES", 50)
+CONVERSATIONS_GROUP = "conversations"
+
+
+def conversation_title(message):
+    return message[:50] + "..." if len(message) > 50 else message
+
+
+def conversations_group(user_id):
+    """Sockets following a user's conversations, anonymous ones share a group"""
+    if user_id is None:
+        return CONVERSATIONS_GROUP
+    return f"{CONVERSATIONS_GROUP}.user.{user_id}"
+
+
+async def publish_changes(changes):
+    """Push conversation changes to the sockets of their owner"""
+    channel_layer = get_channel_layer()
+    for change in changes:
+        await channel_layer.group_send(conversations_group(change["user"]), {
+            "type": "conversations.changed",
+            "change": change
+        })
+
+
+class TurnResult(NamedTuple):
+    reply: str
+    # The stored conversation change, None while a write-behind turn is queued
+    change: dict | None
+
+
+class TurnPipeline:
+    """
+    Handles one chat turn for any transport: generate the reply, store the
+    turn, publish the conversation change.
+
+    WebSocket consumers call run() on the event loop and storing may go
+    through the write-behind queue. The REST API calls run_sync(), which
+    always stores the turn before returning since it answers with the
+    conversation history. Both generate with the configured backend, which
+    is also given the conversation context if it uses one.
+
+    A conversation holds at most `max_messages` before a new one is started,
+    None lets it grow for good and leaves the context builder to keep what
+    the generator sees within budget.
+    """
+
+    def __init__(self, max_messages=MAX_MESSAGES_PER_CONVERSATION, pool=None, backend=None, context_builder=None,
+                 write_behind=None, durability="reply_first"):
+        self.max_messages = max_messages
+        self.pool = pool or GenerationPool()
+        self.backend: GeneratorBackend = backend or RuleBackend(self.pool)
+        self.context_builder = context_builder or ContextBuilder()
+        self.write_behind = write_behind
+        self.durability = durability
+
+    @classmethod
+    def from_settings(cls):
+        max_messages = getattr(settings, "CHAT_CONTEXT", {}).get("MAX_MESSAGES", MAX_MESSAGES_PER_CONVERSATION) or None
+        config = getattr(settings, "CHAT_WRITE_BEHIND", {})
+        write_behind = None
+        if config.get("ENABLED"):
+            # The flusher publishes the changes of each batch once stored
+            write_behind = WriteBehindQueue.from_settings(max_messages, on_flush=publish_changes)
+        pool = GenerationPool.from_settings()
+        return cls(
+            max_messages=max_messages,
+            pool=pool,
+            backend=backend_from_settings(pool),
+            context_builder=ContextBuilder.from_settings(),
+            write_behind=write_behind,
+            durability=config.get("DURABILITY", "reply_first"),
+        )
+
+    async def drain(self):
+        """Store and publish the turns still waiting in the write-behind queue."""
+        if self.write_behind:
+            await self.write_behind.drain()
+
+    def drain_before_shutdown(self, reactor):
+        """Have a Twisted reactor, e.g. Daphne's, wait for drain() before it shuts down."""
+        from twisted.internet import defer
+
+        reactor.addSystemEventTrigger(
+            "before", "shutdown", lambda: defer.Deferred.fromFuture(asyncio.ensure_future(self.drain()))
+        )
+
+    def turn(self, user, message, reply):
+        return Turn(user, message, reply, conversation_title(message))
+
+    async def context(self, user):
+        """The context of the user's conversation, if the backend uses one."""
+        if not self.backend.uses_context:
+            return None
+        try:
+            return await database_sync_to_async(self.context_builder.for_user)(user)
+        except Exception as e:
+            print(f"Context error: {e}")
+            return None
+
+    async def generate(self, message, context=None):
+        """
+        Generate the reply with the configured backend. Returns None when the
+        pool is saturated.
+        """
+        started = time.perf_counter()
+        try:
+            reply = await self.backend.generate(message, context) or default_reply()
+            generation_seconds.observe(time.perf_counter() - started)
+            return reply
+        except PoolSaturated:
+            return None
+        except asyncio.TimeoutError:
+            print(f"AI Response timed out after {self.pool.timeout}s")
+            return "Sorry, that took too long to work out."
+        except Exception as e:
+            print(f"AI Response error: {e}")
+            return "Something went wrong while generating a response."
+
+    def generate_sync(self, message, context=None):
+        return async_to_sync(self.generate)(message, context)
+
+    def persist_sync(self, user, message, reply):
+        return persist_turns([self.turn(user, message, reply)], self.max_messages)[0]
+
+    @database_sync_to_async
+    def persist(self, user, message, reply):
+        try:
+            return self.persist_sync(user, message, reply)
+        except Exception as e:
+            print(f"Database save error: {e}")
+            return None
+
+    async def stream(self, message, context=None):
+        """
+        Yield the reply in chunks as the backend produces them. Raises
+        PoolSaturated when the server is too busy to generate it.
+        """
+        produced = False
+        started = time.perf_counter()
+        try:
+            async for chunk in self.backend.stream(message, context):
+                produced = produced or bool(chunk.strip())
+                yield chunk
+            generation_seconds.observe(time.perf_counter() - started)
+        except PoolSaturated:
+            raise
+        except asyncio.TimeoutError:
+            print(f"AI Response timed out after {self.pool.timeout}s")
+            yield "Sorry, that took too long to work out."
+            return
+        except Exception as e:
+            print(f"AI Response error: {e}")
+            yield "Something went wrong while generating a response."
+            return
+        if not produced:
+            yield default_reply()
+
+    async def store(self, user, message, reply):
+        """Store the turn, returning its change unless it was queued."""
+        if not self.write_behind:
+            return await self.persist(user, message, reply)
+        stored = self.write_behind.submit(self.turn(user, message, reply))
+        if self.durability != "persist_first":
+            # The flush logs and counts turns it failed to store
+            stored.add_done_callback(lambda future: future.cancelled() or future.exception())
+            return None
+        try:
+            return await stored
+        except Exception:
+            return None
+
+    async def finish(self, result, deliver):
+        if deliver:
+            await deliver(result)
+        # Write-behind flushes publish their own changes
+        if result.change and not self.write_behind:
+            await publish_changes([result.change])
+        return result
+
+    async def run(self, user, message, deliver=None):
+        """
+        Handle a turn on the event loop and return its TurnResult, or None if
+        the server is too busy to generate a reply.
+
+        `deliver(result)` is awaited once the reply is ready to be sent, before
+        the change is published, so the sender sees its reply first. A turn
+        whose reply was generated is stored even if the caller is cancelled,
+        e.g. by its socket closing, while it is being stored.
+        """
+        reply = await self.generate(message, await self.context(user))
+        if reply is None:
+            return None
+        change = await asyncio.shield(self.store(user, message, reply))
+        return await self.finish(TurnResult(reply, change), deliver)
+
+    async def run_stream(self, user, message, send_chunk, deliver=None):
+        """
+        Like run(), but `send_chunk(chunk)` is awaited for every chunk of the
+        reply as soon as it is generated.
+
+        Generation runs ahead of the sender, and the turn is stored as soon
+        as the whole reply is known, while chunks may still be going out.
+        """
+        chunks = asyncio.Queue()
+
+        async def produce():
+            parts = []
+            try:
+                async for chunk in self.stream(message, await self.context(user)):
+                    parts.append(chunk)
+                    chunks.put_nowait(chunk)
+            finally:
+                chunks.put_nowait(None)
+            reply = "".join(parts)
+            return reply, await asyncio.shield(self.store(user, message, reply))
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while (chunk := await chunks.get()) is not None:
+                await send_chunk(chunk)
+            reply, change = await producer
+        except PoolSaturated:
+            return None
+        finally:
+            producer.cancel()
+        return await self.finish(TurnResult(reply, change), deliver)
+
+    def run_sync(self, user, message):
+        """
+        Handle a turn from synchronous code, storing it before returning.
+        Raises PoolSaturated if the server is too busy to generate a reply.
+        """
+        context = self.context_builder.for_user(user) if self.backend.uses_context else None
+        reply = self.generate_sync(message, context)
+        if reply is None:
+            raise PoolSaturated()
+        change = self.persist_sync(user, message, reply)
+        try:
+            async_to_sync(publish_changes)([change])
+        except Exception as e:
+            print(f"Publish error: {e}")
+        return TurnResult(reply, change)
+
+
+turns = TurnPipeline.from_settings()
+
+registry.gauge(
+    "chat_generation_pending", "Generations running or waiting in the pool", lambda: turns.pool.pending
+)
+registry.gauge(
+    "chat_generation_queue_depth", "Generations waiting for a free worker", lambda: turns.pool.queue_depth
+)
+registry.gauge(
+    "chat_write_behind_queued", "Turns waiting to be stored",
+    lambda: turns.write_behind.queue.qsize() if turns.write_behind and turns.write_behind.queue else 0,
+)
@@ -1,3 +1,1132 @@
-from django.test import TestCase
+import asyncio
+import atexit
+import base64
+import contextlib
+import json
+import os
+import random
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import Throttled
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from .backends import (
+    FallbackBackend, GeneratorBackend, HTTPBackend, NgramBackend, RuleBackend, backend_from_settings,
+)
+from .batching import BatchScheduler
+from .broker import PubSubBroker
+from .connections import ConnectionTasks
+from .consumers import ChatConsumer
+from .context import ContextBuilder, count_tokens, message_tokens
+from .generation import GenerationPool, PoolSaturated
+from .handlers import Calculator, IntentStore, IntentTable, MathHandler, intents
+from .models import AiMemory, CustomUser, MemoryMessage, UserChat
+from .persistence import Turn, WriteBehindQueue, persist_turns
+from .limits import LIMITS, BucketRegistry, TokenBucket, user_buckets
+from .middleware import JWTAuthMiddlewareStack
+from .routing import websocket_urlpatterns
+from .serializers import ConversationSerializer
+from .services import TurnPipeline, publish_changes, turns
+from .metrics import Registry, write_behind_failed
 
-# Create your tests here.
+
+def regex_replies(table, text_lower):
+    """The replies of the per-key regex loop that IntentMatcher replaced."""
+    responses = []
+    for key, variants in table.greetings.items():
+        if re.search(rf"\b{re.escape(key)}\b", text_lower):
+            responses.append(random.choice(variants))
+    for key, variants in table.goodbyes.items():
+        if re.search(rf"\b{re.escape(key)}\b", text_lower):
+            responses.append(random.choice(variants))
+    for key, reply in table.prompts.items():
+        if key != "default" and re.search(rf"\b{re.escape(key)}\b", text_lower):
+            responses.append(reply)
+    return responses
+
+
+class IntentMatcherTests(SimpleTestCase):
+    def assertSameReplies(self, table, messages):
+        for seed, message in enumerate(messages):
+            text_lower = message.lower()
+            # Both pick reply variants with random.choice in the same order
+            random.seed(seed)
+            expected = regex_replies(table, text_lower)
+            random.seed(seed)
+            self.assertEqual(table.replies(text_lower), expected, message)
+
+    def random_messages(self, table, rng, count):
+        words = [key for key, _ in table.intents] + [
+            "this", "url", "jokes", "goodbye", "HELLO", "hi!", "_hi", "hi_", "café", "see  you", "x", "2+3",
+        ]
+        messages = []
+        for _ in range(count):
+            message = " ".join(rng.choice(words) for _ in range(rng.randint(0, 6)))
+            if rng.random() < 0.3:
+                message = message.replace(" ", rng.choice([",", ".", "  ", "?", ""]))
+            messages.append(message)
+        return messages
+
+    def test_matches_the_regex_loop(self):
+        table = intents.current()
+        self.assertSameReplies(table, self.random_messages(table, random.Random(1), 3000))
+
+    def test_matches_the_regex_loop_on_overlapping_keys(self):
+        table = IntentTable(
+            {"hi": ["Hi!", "Hey!"], "hi there": ["Hello there!"]},
+            {"bye": ["Bye!"], "bye bye": ["Bye bye!"]},
+            {"a url": "URL", "is url": "URL", "url": "Link", "c++": "C++", "what is": "Question", "default": "?"},
+        )
+        self.assertSameReplies(table, self.random_messages(table, random.Random(2), 3000))
+
+
+class IntentStoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "intents.json")
+        self.write('{"greetings": {"hi": ["Hi!"]}, "prompts": {"default": "?"}}')
+        self.store = IntentStore(self.path, reload_interval=0)
+
+    def write(self, text):
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(text)
+        # Make sure the change shows up even on filesystems with coarse timestamps
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_serves_the_rewritten_file(self):
+        old = self.store.current()
+        self.assertEqual(old.replies("hi"), ["Hi!"])
+        self.write('{"greetings": {"hey": ["Hey!"]}, "prompts": {"default": "?"}}')
+        table = self.store.current()
+        self.assertIsNot(table, old)
+        self.assertEqual((table.replies("hi"), table.replies("hey")), ([], ["Hey!"]))
+        self.assertEqual(self.store.reloads, 1)
+
+    def test_keeps_the_old_table_when_the_file_is_broken(self):
+        old = self.store.current()
+        for broken in ['{"greetings": {"hey": ', '{"greetings": {}}', "[]"]:
+            self.write(broken)
+            self.assertIs(self.store.current(), old, broken)
+        self.assertEqual(self.store.reloads, 0)
+        self.assertEqual(old.replies("hi"), ["Hi!"])
+
+    def test_counts_cache_hits_and_misses(self):
+        table = self.store.current()
+        table.replies("hi")
+        table.replies("hi")
+        table.replies("hello there")
+        self.assertEqual(table.cache_info(), {"hits": 1, "misses": 2, "size": 2, "max_size": IntentTable.CACHE_SIZE})
+
+    def test_long_messages_are_not_cached(self):
+        table = self.store.current()
+        long = "hi " + "x" * IntentTable.CACHE_KEY_LENGTH
+        self.assertEqual(table.replies(long), ["Hi!"])
+        self.assertEqual(table.replies(long), ["Hi!"])
+        self.assertEqual(table.cache_info()["size"], 0)
+        self.assertEqual((table.cache_info()["hits"], table.cache_info()["misses"]), (0, 0))
+
+    def test_reload_drops_the_cache_but_keeps_the_counters(self):
+        old = self.store.current()
+        old.replies("hi")
+        old.replies("hi")
+        self.write('{"greetings": {"hi": ["Hello!"]}, "prompts": {"default": "?"}}')
+        table = self.store.current()
+        self.assertEqual(table.cache_info()["size"], 0)
+        # The new table matches afresh rather than answering from the old cache
+        self.assertEqual(table.replies("hi"), ["Hello!"])
+        stats = self.store.stats()
+        self.assertEqual((stats["cache_hits"], stats["cache_misses"], stats["cache_size"]), (1, 2, 1))
+        self.assertEqual(stats["reloads"], 1)
+
+
+class PubSubBrokerTests(SimpleTestCase):
+    async def exchange(self, request):
+        server = await PubSubBroker().start(port=0)
+        try:
+            reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+            writer.write(request)
+            reply = await asyncio.wait_for(reader.read(), timeout=5)
+            writer.close()
+            return reply
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def test_answers_commands(self):
+        reply = await self.exchange(b"*1\r\n$4\r\nPING\r\nPING hi\r\n*1\r\n$4\r\nQUIT\r\n")
+        self.assertEqual(reply, b"+PONG\r\n$2\r\nhi\r\n+OK\r\n")
+
+    async def test_malformed_commands_close_the_connection(self):
+        for request in [b"*x\r\n", b"*1\r\n$x\r\n", b"*1\r\n:4\r\nPING\r\n", b"*1\r\n$-5\r\n"]:
+            reply = await self.exchange(request + b"*1\r\n$4\r\nPING\r\n")
+            self.assertEqual(reply, b"-ERR protocol error\r\n", request)
+
+
+class CalculatorTests(SimpleTestCase):
+    def random_expression(self, rng, depth=0):
+        if depth > 2 or rng.random() < 0.3:
+            return str(rng.randint(0, 999))
+        operator = rng.choice(["+", "-", "*", "/", "%"])
+        left = self.random_expression(rng, depth + 1)
+        right = self.random_expression(rng, depth + 1)
+        return f"({left} {operator} {right})"
+
+    def test_matches_eval(self):
+        rng = random.Random(1)
+        for _ in range(500):
+            expr = self.random_expression(rng)
+            try:
+                expected = eval(expr)
+            except ZeroDivisionError:
+                expected = None
+            self.assertEqual(Calculator.evaluate(expr), expected, expr)
+
+    def test_rejects_long_expressions_without_caching_them(self):
+        Calculator._evaluate.cache_clear()
+        expr = "+".join(["1"] * (Calculator.MAX_LENGTH // 2 + 1))
+        self.assertGreater(len(expr), Calculator.MAX_LENGTH)
+        self.assertIsNone(Calculator.evaluate(expr))
+        self.assertEqual(Calculator._evaluate.cache_info().currsize, 0)
+
+    def test_rejects_large_magnitudes(self):
+        self.assertEqual(Calculator.evaluate("1000000000 * 1000000000"), 10 ** 18)
+        self.assertIsNone(Calculator.evaluate("1000000000 * 1000000001"))
+        self.assertIsNone(Calculator.evaluate("10000000000000000000 - 1"))
+
+    def test_rejects_too_many_steps(self):
+        # Every number and operator is a step
+        self.assertEqual(Calculator.evaluate("+".join(["1"] * 50)), 50)
+        self.assertIsNone(Calculator.evaluate("+".join(["1"] * 51)))
+
+    def test_rejects_large_powers_before_computing_them(self):
+        self.assertEqual(Calculator.evaluate("10 ** 18"), 10 ** 18)
+        self.assertIsNone(Calculator.evaluate("10 ** 19"))
+        self.assertIsNone(Calculator.evaluate("9 ** 9 ** 9"))
+
+    def test_rejects_anything_but_arithmetic(self):
+        for expr in ["__import__('os')", "a + 1", "[1] * 3", "1 if 1 else 2", "'a' * 3", "1j * 1j"]:
+            self.assertIsNone(Calculator.evaluate(expr), expr)
+
+    def test_math_handler_answers_in_words(self):
+        self.assertEqual(MathHandler.process("what is 12 times 3"), "The result of 12 * 3 is 36.")
+
+
+class FlakyBackend(GeneratorBackend):
+    """Fails any batch holding a "bad" message, and that message on its own."""
+
+    async def generate(self, message, context=None):
+        if message == "bad":
+            raise asyncio.TimeoutError()
+        return message.upper()
+
+    async def generate_batch(self, messages, contexts=None):
+        if "bad" in messages:
+            raise asyncio.TimeoutError()
+        return [message.upper() for message in messages]
+
+
+class BatchSchedulerTests(SimpleTestCase):
+    async def test_failed_batch_falls_back_to_single_messages(self):
+        scheduler = BatchScheduler(FlakyBackend(), window=0.05, max_batch=8)
+        replies = await asyncio.gather(
+            scheduler.generate("one"), scheduler.generate("bad"), scheduler.generate("two"),
+            return_exceptions=True,
+        )
+        self.assertEqual(replies[0], "ONE")
+        self.assertIsInstance(replies[1], asyncio.TimeoutError)
+        self.assertEqual(replies[2], "TWO")
+        self.assertEqual(scheduler.batches, 1)
+
+
+class GenerationPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = GenerationPool("process", workers=1, timeout=10)
+        self.addCleanup(lambda: self.pool.executor.shutdown(cancel_futures=True))
+
+    async def start(self):
+        self.pool.start()
+        self.worker = await self.pool.run(os.getpid)
+
+    async def test_recovers_from_a_worker_killed_while_idle(self):
+        await self.start()
+        os.kill(self.worker, signal.SIGKILL)
+        await asyncio.sleep(0.2)
+        self.assertEqual(await self.pool.run(abs, -3), 3)
+        self.assertEqual(self.pool.restarts, 1)
+        self.assertNotEqual(await self.pool.run(os.getpid), self.worker)
+
+    async def test_resubmits_calls_of_a_killed_worker(self):
+        await self.start()
+        call = asyncio.ensure_future(self.pool.run(time.sleep, 0.5))
+        await asyncio.sleep(0.2)
+        os.kill(self.worker, signal.SIGKILL)
+        self.assertIsNone(await call)
+        self.assertEqual(self.pool.restarts, 1)
+        self.assertEqual(self.pool.pending, 0)
+
+    async def test_fails_a_call_that_keeps_killing_its_worker(self):
+        await self.start()
+        with self.assertRaises(BrokenProcessPool):
+            await self.pool.run(os._exit, 1)
+        self.assertEqual(self.pool.restarts, 2)
+        self.assertEqual(self.pool.inflight, {})
+        self.assertEqual(await self.pool.run(abs, -3), 3)
+
+
+class StubBackend(GeneratorBackend):
+    """Answers after `delay` seconds, or raises `error`."""
+    name = "stub"
+
+    def __init__(self, prefix, delay=0.0, error=None):
+        self.prefix = prefix
+        self.delay = delay
+        self.error = error
+
+    async def generate(self, message, context=None):
+        await asyncio.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return f"{self.prefix} {message}"
+
+
+class FallbackBackendTests(SimpleTestCase):
+    def guarded(self, backend, **kwargs):
+        return FallbackBackend(backend, StubBackend("rules"), **kwargs)
+
+    async def test_answers_with_the_backend_within_budget(self):
+        backend = self.guarded(StubBackend("model"), latency_budget=1)
+        self.assertEqual(await backend.generate("hi"), "model hi")
+        self.assertEqual(await backend.generate_batch(["a", "b"]), ["model a", "model b"])
+        self.assertEqual(backend.fallbacks, 0)
+
+    async def test_falls_back_on_timeout(self):
+        backend = self.guarded(StubBackend("model", delay=1), latency_budget=0.05)
+        self.assertEqual(await backend.generate("hi"), "rules hi")
+        self.assertEqual((backend.fallbacks, backend.active), (1, 0))
+
+    async def test_falls_back_on_error(self):
+        backend = self.guarded(StubBackend("model", error=ConnectionError("down")))
+        self.assertEqual(await backend.generate("hi"), "rules hi")
+        self.assertEqual(await backend.generate_batch(["a", "b"]), ["rules a", "rules b"])
+        self.assertEqual(backend.fallbacks, 2)
+
+    async def test_falls_back_past_the_concurrency_limit(self):
+        backend = self.guarded(StubBackend("model", delay=0.1), max_concurrency=1, latency_budget=1)
+        replies = await asyncio.gather(backend.generate("one"), backend.generate("two"))
+        self.assertEqual(replies, ["model one", "rules two"])
+        self.assertEqual((backend.fallbacks, backend.active), (1, 0))
+
+    async def test_stream_falls_back_only_before_the_first_chunk(self):
+        backend = self.guarded(StubBackend("model", delay=1), latency_budget=0.05)
+        self.assertEqual("".join([chunk async for chunk in backend.stream("hi there")]), "rules hi there")
+
+        backend = self.guarded(StubBackend("model"), latency_budget=1)
+        self.assertEqual([chunk async for chunk in backend.stream("hi there")], ["model ", "hi ", "there"])
+        self.assertEqual((backend.fallbacks, backend.active), (0, 0))
+
+
+class ModelServerHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(body)
+        replies = [f"model {message}" for message in body["messages"]]
+        data = json.dumps({"replies": replies[:self.server.reply_count]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ModelServerHandler)
+        self.server.requests = []
+        self.server.reply_count = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.backend = HTTPBackend(f"http://127.0.0.1:{self.server.server_port}/generate", timeout=5)
+
+    async def test_posts_a_batch_and_reads_the_replies(self):
+        context = {"summary": "", "messages": [{"user": "hi", "ai": "hello"}]}
+        self.assertEqual(await self.backend.generate_batch(["a", "b"], [context, None]), ["model a", "model b"])
+        self.assertEqual(self.server.requests, [{"messages": ["a", "b"], "contexts": [context, None]}])
+        self.assertEqual(await self.backend.generate("c"), "model c")
+        self.assertEqual(self.server.requests[-1], {"messages": ["c"], "contexts": [None]})
+
+    async def test_rejects_a_reply_count_mismatch(self):
+        self.server.reply_count = 1
+        with self.assertRaises(ValueError):
+            await self.backend.generate_batch(["a", "b"])
+        fallback = FallbackBackend(self.backend, StubBackend("rules"))
+        self.assertEqual(await fallback.generate_batch(["a", "b"]), ["rules a", "rules b"])
+
+
+class NgramBackendTests(SimpleTestCase):
+    async def test_streams_words_of_the_intent_replies(self):
+        random.seed(1)
+        backend = NgramBackend(GenerationPool("inline"))
+        chunks = [chunk async for chunk in backend.stream("hello there")]
+        self.assertTrue(chunks)
+        replies = " ".join(
+            " ".join(reply) if isinstance(reply, list) else reply for _, reply in intents.current().intents
+        )
+        # It starts from a word of the prompt the model knows, whatever its case
+        words = set(replies.lower().split())
+        for word in "".join(chunks).split():
+            self.assertIn(word.lower(), words)
+
+
+class BackendFromSettingsTests(SimpleTestCase):
+    pool = GenerationPool("inline")
+
+    def backend(self, **config):
+        with override_settings(CHAT_GENERATOR=config):
+            return backend_from_settings(self.pool)
+
+    def test_builds_the_configured_backend(self):
+        self.assertIsInstance(self.backend(BACKEND="rules"), RuleBackend)
+        self.assertIsInstance(self.backend(BACKEND="rules", BATCH_WINDOW=0.01), BatchScheduler)
+
+        backend = self.backend(BACKEND="ngram", MAX_CONCURRENCY=3, LATENCY_BUDGET=0.5)
+        self.assertIsInstance(backend, FallbackBackend)
+        self.assertIsInstance(backend.backend, NgramBackend)
+        self.assertIsInstance(backend.fallback, RuleBackend)
+        self.assertEqual((backend.max_concurrency, backend.latency_budget), (3, 0.5))
+
+        backend = self.backend(BACKEND="http", URL="http://model/generate", BATCH_WINDOW=0.01, MAX_BATCH=4)
+        self.assertIsInstance(backend.backend, BatchScheduler)
+        self.assertIsInstance(backend.backend.backend, HTTPBackend)
+        self.assertEqual((backend.backend.backend.url, backend.backend.max_batch), ("http://model/generate", 4))
+        self.assertTrue(backend.uses_context)
+
+    def test_rejects_an_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            self.backend(BACKEND="gpt")
+
+
+class ConversationListTests(APITestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        other = CustomUser.objects.create_user("bob@example.com", "secret", username="bob")
+        start = timezone.now() - timedelta(days=1)
+        for index in range(25):
+            memory = AiMemory.objects.create(user=self.user, title=f"Conversation {index}")
+            # Pairs share a timestamp, so pages have to break ties on the id
+            AiMemory.objects.filter(pk=memory.pk).update(updated_at=start + timedelta(minutes=index // 2))
+        AiMemory.objects.create(user=other, title="Someone else's")
+        self.client.force_authenticate(self.user)
+        self.url = reverse("conversation_list")
+
+    def expected_ids(self):
+        return list(
+            AiMemory.objects.filter(user=self.user).order_by("-updated_at", "-id").values_list("id", flat=True)
+        )
+
+    def walk(self, url, on_page=None):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [row["id"] for row in response.data["results"]]
+            if on_page:
+                on_page(response)
+            url = response.data["next"]
+        return ids
+
+    def test_pages_follow_each_other(self):
+        self.assertEqual(self.walk(self.url + "?limit=4"), self.expected_ids())
+
+    def test_pages_are_not_shifted_by_updates(self):
+        expected = self.expected_ids()
+        moved = expected[-1]
+
+        def update_once(response):
+            # Bump a conversation from the last page to the top after the first page
+            if not response.wsgi_request.GET.get("cursor"):
+                AiMemory.objects.filter(pk=moved).update(updated_at=timezone.now())
+
+        ids = self.walk(self.url + "?limit=4", on_page=update_once)
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(ids, [pk for pk in expected if pk != moved])
+
+    def test_invalid_cursor(self):
+        wrong_length = base64.urlsafe_b64encode(b"[1]").decode()
+        wrong_value = base64.urlsafe_b64encode(b'["yesterday", 1]').decode()
+        for cursor in ["not a cursor", wrong_length, wrong_value]:
+            response = self.client.get(self.url, {"cursor": cursor})
+            self.assertEqual(response.status_code, 404, cursor)
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Other pages have their own tag
+        self.assertNotEqual(self.client.get(self.url, {"limit": 5})["ETag"], etag)
+
+        persist_turns([Turn(self.user, "hello", "hi", "hello")], None)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_messages_not_modified_until_appended(self):
+        change = persist_turns([Turn(self.user, "hello", "hi", "hello")], None)[0]
+        url = reverse("conversation_messages", args=[change["id"]])
+        etag = self.client.get(url)["ETag"]
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        persist_turns([Turn(self.user, "bye", "see you", "bye")], None)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row["sequence"] for row in response.data["results"]], [0, 1])
+
+
+class MemoryMessageMigrationTests(TransactionTestCase):
+    before = [("victorAiApp", "0005_aimemory_revision")]
+    after = [("victorAiApp", "0006_memorymessage")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_moves_messages_to_rows_and_back(self):
+        apps = self.migrate(self.before)
+        user = apps.get_model("victorAiApp", "CustomUser").objects.create(email="ada@example.com", username="ada")
+        AiMemory = apps.get_model("victorAiApp", "AiMemory")
+        conversations = [
+            [{"user": "hi", "ai": "hello"}, {"user": "bye", "ai": "see you"}],
+            [{"user": "2+2", "ai": "4"}],
+            [],
+        ]
+        blobs = {AiMemory.objects.create(user=user, messages=messages).pk: messages for messages in conversations}
+
+        apps = self.migrate(self.after)
+        AiMemory = apps.get_model("victorAiApp", "AiMemory")
+        MemoryMessage = apps.get_model("victorAiApp", "MemoryMessage")
+        for pk, messages in blobs.items():
+            self.assertEqual(AiMemory.objects.get(pk=pk).message_count, len(messages))
+            rows = MemoryMessage.objects.filter(memory_id=pk).order_by("sequence")
+            self.assertEqual([(row.sequence, row.content) for row in rows], list(enumerate(messages)))
+
+        apps = self.migrate(self.before)
+        AiMemory = apps.get_model("victorAiApp", "AiMemory")
+        for pk, messages in blobs.items():
+            self.assertEqual(AiMemory.objects.get(pk=pk).messages, messages)
+
+
+class PersistTurnsTests(TestCase):
+    def setUp(self):
+        self.ada = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        self.bob = CustomUser.objects.create_user("bob@example.com", "secret", username="bob")
+
+    def turn(self, user, message):
+        return Turn(user, message, message.upper(), message)
+
+    def rows(self, memory_id):
+        return list(MemoryMessage.objects.filter(memory_id=memory_id).values_list("sequence", "content"))
+
+    def test_numbers_messages_in_order_within_a_batch(self):
+        first = persist_turns([self.turn(self.ada, "one")], None)
+        changes = persist_turns(
+            [self.turn(self.ada, "two"), self.turn(self.bob, "hi"), self.turn(self.ada, "three")], None
+        )
+        ada, bob = first[0]["id"], changes[1]["id"]
+        self.assertEqual([change["id"] for change in changes], [ada, bob, ada])
+        self.assertEqual([change["offset"] for change in changes], [1, 0, 2])
+        self.assertEqual([change["revision"] for change in changes], [2, 1, 3])
+        self.assertEqual(
+            self.rows(ada),
+            [(0, {"user": "one", "ai": "ONE"}), (1, {"user": "two", "ai": "TWO"}), (2, {"user": "three", "ai": "THREE"})],
+        )
+        self.assertEqual(self.rows(bob), [(0, {"user": "hi", "ai": "HI"})])
+        memory = AiMemory.objects.get(pk=ada)
+        self.assertEqual((memory.message_count, memory.revision), (3, 3))
+
+    def test_starts_a_new_conversation_at_max_messages(self):
+        persist_turns([self.turn(self.ada, "one")], 2)
+        changes = persist_turns([self.turn(self.ada, name) for name in ["two", "three", "four", "five", "six"]], 2)
+        ids = [change["id"] for change in changes]
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual([change["offset"] for change in changes], [1, 0, 1, 0, 1])
+        self.assertEqual(ids[1], ids[2])
+        self.assertEqual(ids[3], ids[4])
+        self.assertEqual(
+            list(AiMemory.objects.filter(user=self.ada).order_by("id").values_list("message_count", flat=True)),
+            [2, 2, 2],
+        )
+        self.assertEqual([content["user"] for _, content in self.rows(ids[3])], ["five", "six"])
+
+        # A full conversation is not appended to in a later batch either
+        change = persist_turns([self.turn(self.ada, "seven")], 2)[0]
+        self.assertNotIn(change["id"], ids)
+        self.assertEqual(change["offset"], 0)
+
+
+class TokenBucketTests(SimpleTestCase):
+    @mock.patch("victorAiApp.limits.time.monotonic")
+    def test_refills_at_the_rate_up_to_the_burst(self, monotonic):
+        monotonic.return_value = 100.0
+        bucket = TokenBucket(rate=2, burst=3)
+        self.assertEqual([bucket.take() for _ in range(4)], [True, True, True, False])
+        monotonic.return_value = 100.5
+        self.assertEqual([bucket.take() for _ in range(2)], [True, False])
+        monotonic.return_value = 200.0
+        self.assertEqual(sum(bucket.take() for _ in range(5)), 3)
+
+    def test_registry_evicts_the_least_recently_used_bucket(self):
+        buckets = BucketRegistry(rate=0, burst=1, max_size=2)
+        self.assertTrue(buckets.take("a"))
+        self.assertTrue(buckets.take("b"))
+        self.assertFalse(buckets.take("a"))
+        self.assertTrue(buckets.take("c"))
+        self.assertEqual(list(buckets.buckets), ["a", "c"])
+        # "b" was evicted, so it comes back full
+        self.assertTrue(buckets.take("b"))
+        self.assertEqual(list(buckets.buckets), ["c", "b"])
+
+
+class FakeReactor:
+    def __init__(self):
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, event, trigger):
+        self.triggers.append((phase, event, trigger))
+
+
+class WriteBehindQueueTests(TransactionTestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        self.flushed = []
+
+    async def on_flush(self, changes):
+        self.flushed.append([change["offset"] for change in changes])
+
+    def turn(self, message):
+        return Turn(self.user, message, message.upper(), message)
+
+    def queue(self, **kwargs):
+        queue = WriteBehindQueue(None, on_flush=self.on_flush, **kwargs)
+        # Its exit hook would write to the real database
+        self.addCleanup(atexit.unregister, queue.drain_sync)
+        return queue
+
+    def stored(self):
+        return list(UserChat.objects.order_by("id").values_list("message", flat=True))
+
+    async def test_stores_turns_in_batches(self):
+        queue = self.queue(max_batch=3, flush_interval=0.05)
+        changes = await asyncio.gather(*(queue.submit(self.turn(f"turn {index}")) for index in range(4)))
+        self.assertEqual([change["offset"] for change in changes], [0, 1, 2, 3])
+        self.assertEqual(self.flushed, [[0, 1, 2], [3]])
+
+    async def test_failed_batch_stores_turns_one_by_one(self):
+        queue = self.queue(flush_interval=0.05)
+        failed = write_behind_failed.labels().value
+        # A message can't be NULL, so this turn fails its batch
+        changes = await asyncio.gather(
+            queue.submit(self.turn("one")), queue.submit(Turn(self.user, None, "?", "bad")),
+            queue.submit(self.turn("two")), return_exceptions=True,
+        )
+        self.assertEqual(changes[0]["offset"], 0)
+        self.assertIsInstance(changes[1], Exception)
+        self.assertEqual(changes[2]["offset"], 1)
+        self.assertEqual(write_behind_failed.labels().value, failed + 1)
+        self.assertEqual(self.flushed, [[0, 1]])
+        self.assertEqual(await database_sync_to_async(self.stored)(), ["one", "two"])
+
+    async def test_drain_waits_for_queued_turns(self):
+        queue = self.queue(flush_interval=0.2)
+        futures = [queue.submit(self.turn(message)) for message in ["one", "two"]]
+        await queue.drain()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(self.flushed, [[0, 1]])
+
+    def test_drain_sync_stores_collected_turns(self):
+        queue = self.queue(flush_interval=10)
+
+        async def submit():
+            for message in ["one", "two", "three"]:
+                queue.submit(self.turn(message))
+            await asyncio.sleep(0.01)
+
+        # The loop stops while the flusher collects a batch, as at exit
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(submit())
+        self.assertEqual(len(queue.batch), 3)
+        queue.drain_sync()
+        queue.flusher.cancel()
+        loop.run_until_complete(asyncio.gather(queue.flusher, return_exceptions=True))
+        loop.close()
+        self.assertEqual(self.stored(), ["one", "two", "three"])
+        self.assertEqual(self.flushed, [])
+
+    async def test_drains_before_twisted_shutdown(self):
+        queue = self.queue(flush_interval=0.2)
+        reactor = FakeReactor()
+        TurnPipeline(write_behind=queue).drain_before_shutdown(reactor)
+        (phase, event, trigger), = reactor.triggers
+        self.assertEqual((phase, event), ("before", "shutdown"))
+
+        queue.submit(self.turn("one"))
+        await trigger().asFuture(asyncio.get_running_loop())
+        self.assertEqual(self.flushed, [[0]])
+
+
+class ChatConsumerTests(TransactionTestCase):
+    application = JWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+    def setUp(self):
+        user_buckets.buckets.clear()
+
+    @contextlib.asynccontextmanager
+    async def connect(self, path="/ws/chat/"):
+        communicator = WebsocketCommunicator(self.application, path)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            yield communicator
+        finally:
+            await communicator.disconnect()
+
+    async def update(self, communicator, mode):
+        message = await communicator.receive_json_from(timeout=5)
+        self.assertEqual((message["type"], message["mode"]), ("conversation_update", mode))
+        return message["payload"]
+
+    async def chat(self, communicator, message):
+        await communicator.send_json_to({"type": "chat_message", "message": message})
+        reply = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(reply["type"], "chat_response")
+        return reply
+
+    def store(self, *messages):
+        return persist_turns([Turn(None, message, message.upper(), message) for message in messages], None)
+
+    async def test_legacy_socket_gets_snapshots_built_from_changes(self):
+        async with self.connect() as communicator:
+            self.assertEqual(await self.update(communicator, "snapshot"), [])
+
+            with mock.patch.object(ChatConsumer, "get_conversations") as get_conversations:
+                reply = await self.chat(communicator, "hello")
+                (entry,) = await self.update(communicator, "snapshot")
+                self.assertEqual((entry["id"], entry["revision"]), (reply["conversation_id"], 1))
+                self.assertEqual(entry["messages"], [{"user": "hello", "ai": reply["ai_response"]}])
+
+                await self.chat(communicator, "again")
+                (entry,) = await self.update(communicator, "snapshot")
+                self.assertEqual(entry["revision"], 2)
+                self.assertEqual([message["user"] for message in entry["messages"]], ["hello", "again"])
+                get_conversations.assert_not_called()
+
+    async def test_legacy_socket_rereads_after_a_missed_change(self):
+        async with self.connect() as communicator:
+            await self.update(communicator, "snapshot")
+            # Stored without being published, so the next change doesn't follow on
+            await database_sync_to_async(self.store)("unseen")
+
+            await self.chat(communicator, "hello")
+            (entry,) = await self.update(communicator, "snapshot")
+            self.assertEqual([message["user"] for message in entry["messages"]], ["unseen", "hello"])
+
+    async def test_sync_socket_gets_deltas(self):
+        (change, _) = await database_sync_to_async(self.store)("one", "two")
+        async with self.connect("/ws/chat/?sync=1") as communicator:
+            self.assertTrue(await communicator.receive_nothing(0.1))
+
+            known = {change["id"]: {"revision": 1, "count": 1}}
+            await communicator.send_json_to({"type": "sync", "revisions": known})
+            (entry,) = await self.update(communicator, "delta")
+            self.assertEqual((entry["revision"], entry["offset"]), (2, 1))
+            self.assertEqual([message["user"] for message in entry["messages"]], ["two"])
+
+            await self.chat(communicator, "three")
+            (entry,) = await self.update(communicator, "delta")
+            self.assertEqual((entry["revision"], entry["offset"]), (3, 2))
+            self.assertNotIn("title", entry)
+
+            known = {change["id"]: {"revision": 3, "count": 3}}
+            await communicator.send_json_to({"type": "sync", "revisions": known})
+            self.assertEqual(await self.update(communicator, "delta"), [])
+
+            await communicator.send_json_to({"type": "resync"})
+            (entry,) = await self.update(communicator, "snapshot")
+            self.assertEqual((entry["revision"], len(entry["messages"])), (3, 3))
+
+    async def test_sync_does_not_resend_updates_pushed_while_reading(self):
+        await database_sync_to_async(self.store)("one")
+        async with self.connect("/ws/chat/?sync=1") as communicator:
+            read = vars(ChatConsumer)["get_conversations"]
+
+            async def read_then_push(consumer):
+                conversations = await read(consumer)
+                # A turn is stored and pushed before the sync is answered
+                await publish_changes(await database_sync_to_async(self.store)("two"))
+                await asyncio.sleep(0.2)
+                return conversations
+
+            with mock.patch.object(ChatConsumer, "get_conversations", read_then_push):
+                await communicator.send_json_to({"type": "sync", "revisions": {}})
+                (entry,) = await self.update(communicator, "delta")
+                self.assertEqual(entry["revision"], 2)
+                self.assertEqual(await self.update(communicator, "delta"), [])
+
+    @mock.patch("victorAiApp.consumers.IDLE_TIMEOUT", 0.3)
+    async def test_closes_idle_socket(self):
+        async with self.connect() as communicator:
+            await self.update(communicator, "snapshot")
+            await communicator.send_json_to({"type": "ping"})
+            self.assertEqual(await communicator.receive_json_from(), {"type": "pong"})
+            self.assertEqual(await communicator.receive_output(timeout=2), {"type": "websocket.close", "code": 4011})
+
+    @mock.patch("victorAiApp.consumers.IDLE_TIMEOUT", 0.4)
+    async def test_updates_keep_a_listening_socket_open(self):
+        async with self.connect() as communicator:
+            await self.update(communicator, "snapshot")
+            await asyncio.sleep(0.25)
+            await publish_changes(await database_sync_to_async(self.store)("elsewhere"))
+            await self.update(communicator, "snapshot")
+            # Past the timeout since connecting, but not since the update
+            self.assertTrue(await communicator.receive_nothing(0.25))
+            self.assertEqual(await communicator.receive_output(timeout=2), {"type": "websocket.close", "code": 4011})
+
+    async def test_disconnect_stops_connection_tasks(self):
+        connections, live = ConnectionTasks.connections, ConnectionTasks.live
+        async with self.connect() as communicator:
+            await self.update(communicator, "snapshot")
+            self.assertEqual(ConnectionTasks.connections, connections + 1)
+            self.assertEqual(ConnectionTasks.live, live + 2)
+        self.assertEqual((ConnectionTasks.connections, ConnectionTasks.live), (connections, live))
+
+    async def test_turn_is_stored_when_the_socket_closes_while_storing(self):
+        persist = turns.persist
+
+        async def slow_persist(user, message, reply):
+            await asyncio.sleep(0.3)
+            return await persist(user, message, reply)
+
+        with mock.patch.object(turns, "persist", slow_persist):
+            async with self.connect("/ws/chat/?sync=1") as communicator:
+                await communicator.send_json_to({"type": "chat_message", "message": "hello"})
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.5)
+        stored = await database_sync_to_async(lambda: list(UserChat.objects.values_list("message", flat=True)))()
+        self.assertEqual(stored, ["hello"])
+
+    @mock.patch("victorAiApp.consumers.HISTORY_MESSAGES", 3)
+    async def test_conversations_are_sent_as_their_last_messages(self):
+        await database_sync_to_async(self.store)("m0", "m1", "m2", "m3", "m4")
+        async with self.connect() as communicator:
+            (entry,) = await self.update(communicator, "snapshot")
+            self.assertEqual(entry["offset"], 2)
+            self.assertEqual([message["user"] for message in entry["messages"]], ["m2", "m3", "m4"])
+
+            await self.chat(communicator, "m5")
+            (entry,) = await self.update(communicator, "snapshot")
+            self.assertEqual(entry["offset"], 3)
+            self.assertEqual([message["user"] for message in entry["messages"]], ["m3", "m4", "m5"])
+
+        async with self.connect("/ws/chat/?sync=1") as communicator:
+            # A client holding fewer messages than the window starts at gets the window
+            known = {entry["id"]: {"revision": 1, "count": 1}}
+            await communicator.send_json_to({"type": "sync", "revisions": known})
+            (entry,) = await self.update(communicator, "delta")
+            self.assertEqual((entry["offset"], len(entry["messages"])), (3, 3))
+
+            known = {entry["id"]: {"revision": 5, "count": 5}}
+            await communicator.send_json_to({"type": "sync", "revisions": known})
+            (entry,) = await self.update(communicator, "delta")
+            self.assertEqual((entry["offset"], len(entry["messages"])), (5, 1))
+
+    @mock.patch.dict(LIMITS, {"CONNECTION_RATE": 0, "CONNECTION_BURST": 2})
+    async def test_rate_limited_messages_are_dropped(self):
+        async with self.connect("/ws/chat/?sync=1") as communicator:
+            for _ in range(3):
+                await communicator.send_json_to({"type": "nope"})
+            errors = [await communicator.receive_json_from() for _ in range(3)]
+            self.assertEqual(
+                sorted(error.get("code", error["message"]) for error in errors),
+                ["Unknown message type", "Unknown message type", "rate_limited"],
+            )
+
+    @mock.patch("victorAiApp.consumers.user_buckets", BucketRegistry(rate=0, burst=1))
+    async def test_sockets_of_one_user_share_a_bucket(self):
+        async with self.connect("/ws/chat/?sync=1") as first, self.connect("/ws/chat/?sync=1") as second:
+            await first.send_json_to({"type": "nope"})
+            self.assertEqual(await first.receive_json_from(), {"type": "error", "message": "Unknown message type"})
+            await second.send_json_to({"type": "nope"})
+            self.assertEqual((await second.receive_json_from())["code"], "rate_limited")
+
+    @mock.patch.dict(LIMITS, {"INBOUND_QUEUE": 1})
+    async def test_messages_past_the_inbound_queue_are_dropped(self):
+        generate = turns.generate
+
+        async def slow_generate(message, context=None):
+            await asyncio.sleep(0.3)
+            return await generate(message, context)
+
+        with mock.patch.object(turns, "generate", slow_generate):
+            async with self.connect("/ws/chat/?sync=1") as communicator:
+                # One being answered, one waiting, one too many
+                for message in ["one", "two", "three"]:
+                    await communicator.send_json_to({"type": "chat_message", "message": message})
+                    await asyncio.sleep(0.05)
+                error = await communicator.receive_json_from()
+                self.assertEqual(error["code"], "queue_full")
+                replies = [await communicator.receive_json_from(timeout=5) for _ in range(4)]
+                answered = [reply["user_message"] for reply in replies if reply["type"] == "chat_response"]
+                self.assertEqual(answered, ["one", "two"])
+
+
+    async def test_a_token_scopes_the_socket_to_its_user(self):
+        def setup():
+            ada = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+            bob = CustomUser.objects.create_user("bob@example.com", "secret", username="bob")
+            (mine,) = persist_turns([Turn(ada, "mine", "ok", "mine")], None)
+            (theirs,) = persist_turns([Turn(bob, "theirs", "ok", "theirs")], None)
+            return str(AccessToken.for_user(ada)), mine["id"], theirs["id"]
+
+        token, mine, theirs = await database_sync_to_async(setup)()
+        await database_sync_to_async(self.store)("anonymous")
+
+        async with self.connect(f"/ws/chat/?token={token}") as communicator:
+            self.assertEqual([entry["id"] for entry in await self.update(communicator, "snapshot")], [mine])
+
+            # Naming another user's conversation doesn't reveal it
+            await communicator.send_json_to({"type": "sync", "revisions": {theirs: {"revision": 0, "count": 0}}})
+            self.assertEqual([entry["id"] for entry in await self.update(communicator, "delta")], [mine])
+
+            reply = await self.chat(communicator, "again")
+            self.assertEqual(reply["conversation_id"], mine)
+
+        # The Authorization header works too
+        communicator = WebsocketCommunicator(
+            self.application, "/ws/chat/", headers=[(b"authorization", f"Bearer {token}".encode())]
+        )
+        await communicator.connect()
+        try:
+            self.assertEqual([entry["id"] for entry in await self.update(communicator, "snapshot")], [mine])
+        finally:
+            await communicator.disconnect()
+
+    async def test_a_bad_token_closes_the_socket(self):
+        communicator = WebsocketCommunicator(self.application, "/ws/chat/?token=not-a-token")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(
+            await communicator.receive_json_from(), {"type": "error", "message": "Invalid or expired token"}
+        )
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": 4001})
+        await communicator.wait()
+
+    async def test_rest_and_socket_turns_share_the_pipeline(self):
+        def setup():
+            ada = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+            return ada, str(AccessToken.for_user(ada))
+
+        def post(message):
+            serializer = ConversationSerializer(data={"message": message}, context={"user": ada})
+            self.assertTrue(serializer.is_valid())
+            return serializer.save()
+
+        ada, token = await database_sync_to_async(setup)()
+        async with self.connect(f"/ws/chat/?token={token}&sync=1") as communicator:
+            await communicator.send_json_to({"type": "sync", "revisions": {}})
+            self.assertEqual(await self.update(communicator, "delta"), [])
+
+            # A REST turn is stored and pushed like a socket turn
+            await database_sync_to_async(post)("from rest")
+            (entry,) = await self.update(communicator, "delta")
+            self.assertEqual((entry["revision"], entry["offset"]), (1, 0))
+
+            reply = await self.chat(communicator, "from socket")
+            self.assertEqual(reply["conversation_id"], entry["id"])
+            (entry,) = await self.update(communicator, "delta")
+            self.assertEqual((entry["revision"], entry["offset"]), (2, 1))
+
+        history = (await database_sync_to_async(post)("again"))["conversation_history"]
+        self.assertEqual([line.split(" | ")[0] for line in history], ["from rest", "from socket", "again"])
+
+
+class ContextBuilderTests(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        self.builder = ContextBuilder(max_tokens=100, summary_tokens=40)
+
+    def store(self, count, start=0):
+        # Every turn is 12 tokens
+        persist_turns(
+            [Turn(self.user, f"question {index} about this", f"answer {index} to that one", "q") for index in
+             range(start, start + count)],
+            None,
+        )
+        return AiMemory.objects.get(user=self.user)
+
+    def test_short_conversations_are_sent_whole(self):
+        context = self.builder.build(self.store(3))
+        self.assertEqual(context, {"summary": "", "messages": [
+            {"user": f"question {index} about this", "ai": f"answer {index} to that one"} for index in range(3)
+        ]})
+        self.assertEqual(AiMemory.objects.get(user=self.user).summary_upto, 0)
+
+    def test_keeps_the_newest_turns_within_the_budget(self):
+        memory = self.store(10)
+        context = self.builder.build(memory)
+        kept = context["messages"]
+        # Folded down to half of what's left of the budget after the summary
+        self.assertLessEqual(sum(map(message_tokens, kept)), (100 - 40) // 2)
+        self.assertEqual(kept[-1]["user"], "question 9 about this")
+        self.assertLessEqual(count_tokens(context["summary"]), 40)
+
+        stored = AiMemory.objects.get(pk=memory.pk)
+        self.assertEqual(stored.summary_upto, 10 - len(kept))
+        self.assertEqual(stored.summary, context["summary"])
+        # The summary ends with the newest folded turn
+        self.assertIn(f"question {9 - len(kept)}", context["summary"].splitlines()[-1])
+
+    def test_reads_only_what_follows_the_summary(self):
+        memory = self.store(10)
+        self.builder.build(memory)
+        upto = memory.summary_upto
+        memory = self.store(1, start=10)
+        with self.assertNumQueries(1):
+            context = self.builder.build(memory)
+        self.assertEqual(len(context["messages"]), 10 - upto + 1)
+        self.assertEqual(AiMemory.objects.get(pk=memory.pk).summary_upto, upto)
+
+    def test_a_builder_that_lost_the_race_takes_the_stored_summary(self):
+        memory = self.store(10)
+        stale = AiMemory.objects.get(pk=memory.pk)
+        self.builder.build(memory)
+        self.builder.build(stale)
+        self.assertEqual((stale.summary, stale.summary_upto), (memory.summary, memory.summary_upto))
+        stored = AiMemory.objects.get(pk=memory.pk)
+        self.assertEqual((stored.summary, stored.summary_upto), (memory.summary, memory.summary_upto))
+
+
+class ConversationSerializerTests(TestCase):
+    @mock.patch("victorAiApp.serializers.HISTORY_MESSAGES", 3)
+    def test_history_is_the_last_messages(self):
+        user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        persist_turns([Turn(user, f"m{index}", "ok", "m") for index in range(5)], None)
+        serializer = ConversationSerializer(data={"message": "hello"}, context={"user": user})
+        self.assertTrue(serializer.is_valid())
+        history = serializer.save()["conversation_history"]
+        self.assertEqual(len(history), 3)
+        self.assertEqual([line.split(" | ")[0] for line in history], ["m3", "m4", "hello"])
+
+    def test_a_saturated_pool_is_throttled(self):
+        user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        serializer = ConversationSerializer(data={"message": "hello"}, context={"user": user})
+        self.assertTrue(serializer.is_valid())
+        with mock.patch.object(turns.backend, "generate", mock.AsyncMock(side_effect=PoolSaturated)):
+            with self.assertRaises(Throttled) as raised:
+                serializer.save()
+        self.assertEqual(raised.exception.status_code, 429)
+        self.assertFalse(MemoryMessage.objects.exists())
+
+
+class MetricsViewTests(TestCase):
+    def setUp(self):
+        self.url = reverse("metrics")
+
+    def test_refused_without_token_or_staff(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada")
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    @override_settings(CHAT_METRICS_TOKEN="scrape-me")
+    def test_served_with_the_token(self):
+        self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer scrape-me")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE chat_messages_total counter", response.content)
+
+    def test_served_to_staff(self):
+        user = CustomUser.objects.create_user("ada@example.com", "secret", username="ada", is_staff=True)
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+
+class RegistryTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.registry = Registry(directory=self.directory)
+        self.registry.counter("turns_total", "Turns", ["intent"]).labels(intent="math").inc(2)
+        self.registry.gauge("open", "Open sockets", lambda: 3)
+        self.registry.histogram("seconds", "Seconds", buckets=(0.1, 1.0)).observe(0.05)
+        process = subprocess.Popen(["true"])
+        process.wait()
+        self.dead = process.pid
+
+    def write(self, name, pid, updated, turns, open_sockets, seconds):
+        snapshot = {
+            "pid": pid,
+            "started": updated - 1,
+            "updated": updated,
+            "metrics": {
+                "turns_total": {"type": "counter", "help": "Turns", "samples": [[{"intent": "math"}, turns]]},
+                "open": {"type": "gauge", "help": "Open sockets", "samples": [[{}, open_sockets]]},
+                "seconds": {"type": "histogram", "help": "Seconds", "samples": [
+                    [{}, {"buckets": [0.1, 1.0], "counts": [0, 1, 0], "sum": seconds}]
+                ]},
+            },
+        }
+        path = os.path.join(self.directory, name)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        return path
+
+    def test_adds_up_live_and_exited_processes(self):
+        started = self.registry.started
+        self.write("live.json", os.getppid(), started + 1, turns=5, open_sockets=4, seconds=0.5)
+        self.write("exited.json", self.dead, started + 1, turns=7, open_sockets=100, seconds=0.25)
+        stale = self.write("stale.json", self.dead, started - 10, turns=1000, open_sockets=1000, seconds=9.0)
+
+        lines = self.registry.render().splitlines()
+        # Counters and histograms of an exited worker are kept, its gauges dropped
+        self.assertIn('turns_total{intent="math"} 14', lines)
+        self.assertIn("open 7", lines)
+        self.assertIn('seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("seconds_count 3", lines)
+        self.assertIn("seconds_sum 0.8", lines)
+        # A snapshot older than every live process is from an earlier run
+        self.assertFalse(os.path.exists(stale))
+
+    def test_without_a_directory_only_this_process_counts(self):
+        registry = Registry(directory="")
+        registry.counter("turns_total", "Turns").inc()
+        self.assertIn("turns_total 1", registry.render().splitlines())
@@ -10,6 +10,9 @@ from .serializers import CustomUserTokenObtainSerializer
 urlpatterns = [
     path('api/token/', TokenObtainPairView.as_view(serializer_class=CustomUserTokenObtainSerializer), name='token_obtain_pair'),
     path('api/token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('api/conversations/', ConversationListView.as_view(), name='conversation_list'),
+    path('api/conversations/<int:pk>/messages/', ConversationMessagesView.as_view(), name='conversation_messages'),
+    path('metrics/', metrics_view, name='metrics'),
     # path('api/register/', RegisterView.as_view(), name='sign_up'),
     # path('test/', test_view.as_view(), name='sign_up'),
 ]
@@ -1,6 +1,15 @@
+import hashlib
+import hmac
+from django.conf import settings
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.views import APIView
-from rest_framework import status
+from rest_framework import generics, status
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from .metrics import registry
+from .models import AiMemory, MemoryMessage
+from .pagination import KeysetPagination, MessagePagination
 from .serializers import *
 
 # class RegisterView(APIView):
@@ -16,9 +25,77 @@ from .serializers import *
 
 
 # In your app's views.py
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden
 
 def test_view(request):
     return HttpResponse("App routing works!")
 
 
+def metrics_allowed(request):
+    """Whether the request carries the metrics token or comes from a staff user"""
+    token = getattr(settings, "CHAT_METRICS_TOKEN", "")
+    if token:
+        sent = request.headers.get("Authorization", "")
+        if hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+            return True
+    return request.user.is_authenticated and request.user.is_staff
+
+
+def metrics_view(request):
+    """Metrics of every process of this deployment, for Prometheus to scrape"""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def conversations_etag(request, *args, **kwargs):
+    """
+    Hashes the rows of the requested page, read with the same index range scan
+    as the page itself, so it costs the same however many conversations the
+    user has. A conversation that changes moves to the first page.
+    """
+    paginator = KeysetPagination()
+    rows = paginator.paginate_queryset(
+        AiMemory.objects.filter(user=request.user).only("id", "revision", "updated_at"), request
+    )
+    versions = ",".join(f"{row.id}.{row.revision}.{row.updated_at.isoformat()}" for row in rows)
+    key = f"{request.user.pk}:{versions}:{paginator.has_next}:{request.GET.urlencode()}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def messages_etag(request, pk, *args, **kwargs):
+    """Messages are append-only, so a page only changes with the revision"""
+    revision = AiMemory.objects.filter(user=request.user, pk=pk).values_list("revision", flat=True).first()
+    if revision is None:
+        return None
+    key = f"{pk}:{revision}:{request.GET.urlencode()}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+class ConversationListView(generics.ListAPIView):
+    """The user's conversations, most recently updated first"""
+    serializer_class = ConversationListSerializer
+    pagination_class = KeysetPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return AiMemory.objects.filter(user=self.request.user)
+
+    @method_decorator(condition(etag_func=conversations_etag))
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class ConversationMessagesView(generics.ListAPIView):
+    """The messages of one of the user's conversations, oldest first"""
+    serializer_class = MemoryMessageSerializer
+    pagination_class = MessagePagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        memory = generics.get_object_or_404(AiMemory, user=self.request.user, pk=self.kwargs["pk"])
+        return MemoryMessage.objects.filter(memory=memory)
+
+    @method_decorator(condition(etag_func=messages_etag))
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)